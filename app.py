@@ -6,6 +6,9 @@ import json
 import sys
 
 from lib.vboxmachine import VBoxMachine
+from lib.ingest import default_ingestor
+from lib.executor import execute_parallel, print_summary
+from lib.vmfarm import VMFarm
 from exception import VBoxLibException
 
 # GLOBALS
@@ -28,11 +31,56 @@ parser.add_argument('-u', '--username', help='set username for VM',
 parser.add_argument('-p', '--password', help='set password for VM',
         required='--config' not in sys.argv and '-c' not in sys.argv)
 parser.add_argument('-s', '--sample', help='set which sample to deploy on VM',
-        required='--config' not in sys.argv and '-c' not in sys.argv, type=lambda x: is_valid_path(parser, x))
+        required='--config' not in sys.argv and '-c' not in sys.argv and '--prepare' not in sys.argv,
+        type=lambda x: is_valid_path(parser, x))
+parser.add_argument('-wt', '--wait_time', help='seconds to let the sample run (maximum with --adaptive)', type=int,
+        default=30)
+parser.add_argument('--adaptive', help='end the detonation once the guest activity goes quiet', action='store_true')
+parser.add_argument('--min_wait', help='with --adaptive, minimum seconds to let the sample run', type=int, default=5)
+parser.add_argument('--quiet_period', help='with --adaptive, seconds without activity which end the detonation',
+        type=int, default=10)
+parser.add_argument('--compact_registry', help='keep only digests of large registry values in the guest baseline '
+        '(less memory, large old values are reported by digest)', action='store_true')
+parser.add_argument('--baseline', help='with online snapshots, snapshot the guest registry and processes once, before '
+        'the first sample is copied, and reuse them afterwards', action='store_true')
+parser.add_argument('--registry_notify', help='log the registry changes as they happen instead of diffing the '
+        'registry at the end', action='store_true')
+parser.add_argument('--registry_check', help='with --registry_notify, diff the registry at the end too, to log the '
+        'changes missed by the notifications', action='store_true')
+parser.add_argument('--capture_files', help='add the files created/modified by the sample to the results (within a '
+        'budget of files and bytes, files/ in the results)', action='store_true')
+parser.add_argument('--suspend_all', help='at the end, suspend every new process on the guest, not only the ones '
+        'started by the sample', action='store_true')
+parser.add_argument('--hunter_full', help='scan all the guest processes with hollows_hunter, not only the ones of the '
+        'sample', action='store_true')
+parser.add_argument('--procdump', help='dump the memory of the suspended processes with procdump '
+        '(dumps/procdump_<PID>.dmp in the results)', action='store_true')
+parser.add_argument('--procdump_limit', help='number of procdump instances to run at the same time', type=int,
+        default=4)
+parser.add_argument('--stream', help='pull the results from the guest in chunks while the sample runs (chunks in '
+        'stream/ in the results)', action='store_true')
+parser.add_argument('--trace', help='also export the timings of the run as a Chrome trace (trace.json in the results)',
+        action='store_true')
+parser.add_argument('-f', '--force', help='run the experiments even if the results are already cached',
+        action='store_true')
+parser.add_argument('-j', '--parallel', help='number of VMs to run at the same time (each VM has its own log in logs/)',
+        type=int, default=0)
+parser.add_argument('--prepare', help='build golden snapshots (snapshot with tools deployed) for the VMs',
+        action='store_true')
+parser.add_argument('--online', help='with --prepare, take golden snapshots of the running VMs (resumed instead of '
+        'booted)', action='store_true')
+parser.add_argument('--farm', help='run the experiments on N linked clones of the VM (in parallel)', type=int,
+        default=0)
+parser.add_argument('--keep_farm', help='do not remove the linked clones at the end', action='store_true')
+parser.add_argument('--mock', help='use a mock VirtualBox backend (for testing without VirtualBox)',
+        action='store_true')
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
+    if args.prepare and args.mock:
+        parser.error('--prepare can\'t be used with --mock, the mock machines and their snapshots are lost when the '
+                'process exits')
     vms = []
 
     if args.config:
@@ -48,7 +96,7 @@ if __name__ == '__main__':
                         print('[!] Missing username/password from:\n%s' % (json.dumps(e, indent=4),),
                                 file=sys.stderr)
                         continue
-                    if 'sample' not in e and not args.sample:
+                    if 'sample' not in e and not args.sample and not args.prepare:
                         print('[!] Missing sample from:\n%s' % (json.dumps(e, indent=4),), file=sys.stderr)
                         continue
                     elif 'sample' in e and not os.path.isfile(e['sample']):
@@ -78,19 +126,74 @@ if __name__ == '__main__':
             'snapshot': args.snapshot
         })
 
+    for vbox_params in vms:
+        vbox_params.update({
+            'wait_time': args.wait_time,
+            'adaptive_wait': args.adaptive,
+            'min_wait': args.min_wait,
+            'quiet_period': args.quiet_period,
+            'compact_registry': args.compact_registry,
+            'use_baseline': args.baseline,
+            'registry_notify': args.registry_notify,
+            'registry_check': args.registry_check,
+            'capture_files': args.capture_files,
+            'suspend_all': args.suspend_all,
+            'hunter_full': args.hunter_full,
+            'procdump': args.procdump,
+            'procdump_limit': args.procdump_limit,
+            'stream': args.stream,
+            'trace': args.trace,
+            'use_cache': not args.force
+        })
+        if args.mock:
+            vbox_params['backend'] = 'mock'
+
+    if args.prepare:
+        prepared = []
+        for vbox_params in vms:
+            if (vbox_params['name'], vbox_params['snapshot']) in prepared:
+                continue
+            prepared.append((vbox_params['name'], vbox_params['snapshot']))
+
+            vbx = VBoxMachine(**vbox_params, use_golden=False)
+            try:
+                golden = vbx.prepare(online=args.online)
+                print('[#] Golden snapshot [%s] of [%s] is ready' % (golden.name, vbx.name))
+            except VBoxLibException as e:
+                print(e, file=sys.stderr)
+                raise
+        sys.exit(0)
+
+    if args.farm > 0:
+        if len(set((v['name'], v['snapshot']) for v in vms)) > 1:
+            print('[!] A farm is built from a single VM/snapshot!', file=sys.stderr)
+            sys.exit(-1)
+
+        farm = VMFarm(vms[0]['name'], vms[0]['snapshot'], backend='mock' if args.mock else None)
+        try:
+            workers = farm.workers() if farm.create(args.farm) else []
+            # distribute the experiments between the clones
+            for idx, vbox_params in enumerate(vms):
+                vbox_params.update(workers[idx % len(workers)])
+            results = execute_parallel(vms, len(workers))
+        finally:
+            if not args.keep_farm:
+                farm.teardown()
+        print_summary(results)
+        sys.exit(0 if all(r['status'] == 'done' for r in results) else 1)
+
+    if args.parallel > 0:
+        results = execute_parallel(vms, args.parallel)
+        print_summary(results)
+        sys.exit(0 if all(r['status'] == 'done' for r in results) else 1)
+
     for vbox_params in vms:
         vbx = VBoxMachine(**vbox_params)
 
         try:
-            vbx.restore_snapshot()
-            vbx.launch()
-            vbx.deploy_necessary_files()
-            vbx.launch_client_app()
-            vbx.power_off()
+            vbx.run()
         except VBoxLibException as e:
-            try:
-                vbx.power_off()
-            except Exception:
-                pass
             print(e, file=sys.stderr)
             raise
+    # the VM is free for the next sample while the results of the previous one are ingested
+    default_ingestor().wait()
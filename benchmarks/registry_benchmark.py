@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Compares the default and compact (--compact_registry) registry snapshots of RegistryWatcher: time of the snapshot
+and of a diff right after it, memory held by the snapshot and size of the pickled baseline. Runs on a Windows guest,
+with the tools deployed (C:\\maltest\\tools\\python\\python.exe registry_benchmark.py).
+"""
+
+import os
+import sys
+import time
+import pickle
+import argparse
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tools', 'common'))
+
+from registrytool import RegistryWatcher  # NOQA
+
+
+
+def bench(compact, threads):
+    """Returns:
+        dict with the durations of the snapshot and the diff, the memory held by the snapshot and its pickled size
+    """
+    watcher = RegistryWatcher(output=open(os.devnull, 'w'), compact=compact, threads=threads)
+    t0 = time.time()
+    watcher.snap()
+    snap_time = time.time() - t0
+    t0 = time.time()
+    watcher.diff()
+    diff_time = time.time() - t0
+    size = len(pickle.dumps(watcher.d, pickle.HIGHEST_PROTOCOL))
+
+    # traced apart, tracemalloc slows the snapshot down
+    tracemalloc.start()
+    watcher = RegistryWatcher(output=open(os.devnull, 'w'), compact=compact, threads=threads)
+    watcher.snap()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return {'snap': snap_time, 'diff': diff_time, 'memory': memory, 'pickled': size}
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+
+    args.add_argument('-t', '--threads', help='threads walking the registry', default=8, type=int)
+    args.add_argument('-r', '--rounds', help='runs of each mode, the fastest is kept', default=3, type=int)
+
+    argp = args.parse_args()
+
+    print('%-8s %10s %10s %12s %12s' % ('mode', 'snap', 'diff', 'memory', 'pickled'))
+    for compact in (False, True):
+        results = [bench(compact, argp.threads) for _ in range(argp.rounds)]
+        print('%-8s %9.3fs %9.3fs %10.1fMB %10.1fMB' % ('compact' if compact else 'default',
+                min(r['snap'] for r in results), min(r['diff'] for r in results), results[0]['memory'] / 2 ** 20,
+                results[0]['pickled'] / 2 ** 20))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Compares the compiled registry whitelist (tools/common/whitelist.py) with matching every path against every
+pattern with `fnmatch`, on a synthetic set of key paths. Both must exclude exactly the same paths.
+"""
+
+import os
+import sys
+import time
+import random
+import fnmatch
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tools', 'common'))
+
+from whitelist import Whitelist  # NOQA
+
+REG_WHITELIST = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tools', 'common',
+        'registry.whitelist')
+WORDS = ('software', 'microsoft', 'windows', 'currentversion', 'explorer', 'classes', 'clsid', 'policies', 'run',
+        'services', 'controlset001', 'control', 'wow6432node', 'action center', 'checks', 'inprocserver32')
+
+
+
+def fnmatch_whitelisted(patterns, path):
+    pth = path.lower().replace('\\', '/')
+    for e in patterns:
+        if fnmatch.fnmatch(pth, e):
+            return True
+
+
+def synthetic_patterns(rnd, count):
+    patterns = []
+    for _ in range(count):
+        parts = ['hklm' if rnd.random() < 0.5 else 'hkcu'] + [rnd.choice(WORDS) for _ in range(rnd.randint(3, 6))]
+        if rnd.random() < 0.8:
+            parts.append('*')
+        else:
+            parts[rnd.randrange(1, len(parts))] = '*'
+        patterns.append('/'.join(parts))
+    return patterns
+
+
+def synthetic_keys(rnd, count):
+    keys = []
+    for _ in range(count):
+        parts = ['HKLM' if rnd.random() < 0.5 else 'HKCU'] + [rnd.choice(WORDS).title() for _ in
+                range(rnd.randint(1, 8))]
+        if rnd.random() < 0.3:
+            parts.append('{%08X-0000}' % (rnd.getrandbits(32),))
+        keys.append('/'.join(parts))
+    return keys
+
+
+def bench(name, func, keys):
+    t0 = time.time()
+    result = [bool(func(k)) for k in keys]
+    print('%-10s %8.3f sec. (%d excluded)' % (name, time.time() - t0, sum(result)))
+    return result
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+
+    args.add_argument('-k', '--keys', help='number of synthetic key paths', default=200000, type=int)
+    args.add_argument('-p', '--patterns', help='number of synthetic patterns added to the whitelist file', default=50,
+            type=int)
+    args.add_argument('-s', '--seed', default=0, type=int)
+
+    argp = args.parse_args()
+
+    rnd = random.Random(argp.seed)
+    with open(REG_WHITELIST) as fr:
+        patterns = [p.strip() for p in fr.readlines() if p.strip()]
+    patterns += synthetic_patterns(rnd, argp.patterns)
+    keys = synthetic_keys(rnd, argp.keys)
+    # the keys matched by the whitelist file itself
+    keys += [p.replace('*', 'Sub/Key') for p in patterns]
+
+    lowered = [p.lower().replace('\\', '/') for p in patterns]
+    print('[#] %d keys, %d patterns' % (len(keys), len(patterns)))
+    expected = bench('fnmatch', lambda k: fnmatch_whitelisted(lowered, k), keys)
+    whitelist = Whitelist(patterns)
+    result = bench('compiled', whitelist.matches, keys)
+
+    if result != expected:
+        print('[!] ERROR: compiled whitelist differs from fnmatch on %d keys' % (sum(a != b for a, b in
+                zip(result, expected)),))
+        sys.exit(1)
+    print('[#] Same result')
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import hashlib
+import zipfile
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/..')
+
+from exception import VBoxLibException  # NOQA
+
+PROJECT_DIR = os.path.dirname(os.path.realpath(__file__)) + '/..'
+TOOLS_DIR = os.path.join(PROJECT_DIR, 'tools')
+BUNDLES_DIR = os.path.join(PROJECT_DIR, 'cache', 'bundles')
+# archives that are unpacked in the bundle instead of being shipped as they are
+INLINED_ARCHIVES = ('python.zip',)
+VERSION_FN = 'bundle.version'
+
+
+
+def tools_files(architecture):
+    """Files deployed in the guest tools directory, common files override architecture specific ones.
+
+    Args:
+        architecture (str): '64' or '86'
+
+    Returns:
+        list of (name, path) tuples, sorted by name
+    """
+    files = {}
+    for d in (os.path.join(TOOLS_DIR, 'x%s' % (architecture,)), os.path.join(TOOLS_DIR, 'common')):
+        if not os.path.isdir(d):
+            raise VBoxLibException('Tools directory [%s] does not exist!' % (d,))
+        for f in os.listdir(d):
+            if os.path.isfile(os.path.join(d, f)):
+                files[f] = os.path.normpath(os.path.join(d, f))
+
+    return sorted(files.items())
+
+
+def _file_stats(files):
+    return {name: [os.path.getsize(path), os.path.getmtime(path)] for name, path in files}
+
+
+def bundle_hash(architecture):
+    """Computes the version of the tools bundle. File contents are hashed only when their size or modification time
+    differs from the last computation.
+
+    Returns:
+        str: SHA-256 hex digest of the tool files
+    """
+    files = tools_files(architecture)
+    stats = _file_stats(files)
+    state_fn = os.path.join(BUNDLES_DIR, 'x%s.json' % (architecture,))
+
+    try:
+        state = json.loads(open(state_fn).read())
+        if state['files'] == stats:
+            return state['hash']
+    except Exception:
+        pass
+
+    h = hashlib.sha256()
+    for name, path in files:
+        h.update(name.encode() + b'\0')
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        h.update(b'\0')
+
+    os.makedirs(BUNDLES_DIR, exist_ok=True)
+    tmp_fn = '%s.%d.tmp' % (state_fn, os.getpid())
+    with open(tmp_fn, 'w') as f:
+        f.write(json.dumps({'files': stats, 'hash': h.hexdigest()}))
+    os.replace(tmp_fn, state_fn)
+
+    return h.hexdigest()
+
+
+def build_bundle(architecture):
+    """Returns the tools bundle for the given architecture, building it if the tool files changed.
+
+    The bundle is a single archive with the content of the guest tools directory: the tool files, the content of the
+    INLINED_ARCHIVES and a VERSION_FN file holding the bundle hash.
+
+    Returns:
+        tuple of (path, hash)
+    """
+    version = bundle_hash(architecture)
+    bundle_fn = os.path.join(BUNDLES_DIR, 'tools_x%s_%s.zip' % (architecture, version[:16]))
+    if os.path.isfile(bundle_fn):
+        return bundle_fn, version
+
+    print('[#] Building x%s tools bundle [%s]...' % (architecture, version[:16]))
+    # parallel runs may build the same bundle
+    tmp_fn = '%s.%d.tmp' % (bundle_fn, os.getpid())
+    with zipfile.ZipFile(tmp_fn, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for name, path in tools_files(architecture):
+            if name in INLINED_ARCHIVES:
+                with zipfile.ZipFile(path) as inlined:
+                    for info in inlined.infolist():
+                        bundle.writestr(info, inlined.read(info), zipfile.ZIP_DEFLATED)
+            else:
+                bundle.write(path, name)
+        bundle.writestr(VERSION_FN, version)
+    os.replace(tmp_fn, bundle_fn)
+
+    # remove outdated bundles
+    prefix = 'tools_x%s_' % (architecture,)
+    for f in os.listdir(BUNDLES_DIR):
+        if f.startswith(prefix) and f.endswith('.zip') and f != os.path.basename(bundle_fn):
+            os.remove(os.path.join(BUNDLES_DIR, f))
+
+    return bundle_fn, version
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+
+from collections import OrderedDict
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/..')
+
+from lib.vboxmachine import VBoxMachine  # NOQA
+
+PROJECT_DIR = os.path.dirname(os.path.realpath(__file__)) + '/..'
+LOGS_DIR = os.path.join(PROJECT_DIR, 'logs')
+
+
+
+class LogFile:
+
+
+    def __init__(self, filename):
+        self.filename = filename
+
+
+    def write(self, s):
+        open(self.filename, 'a').write(s)
+
+
+    def flush(self):
+        pass
+
+
+
+def run_vm_experiments(vm_name, experiments, log_dir=LOGS_DIR):
+    """Runs, one after another, all the experiments assigned to a VM. Meant to be executed in a worker process, every
+    message (including tracebacks) is written in the VM's own log file. The results of an experiment are ingested
+    while the next experiments run.
+
+    Args:
+        vm_name (str): name of the VM
+        experiments (list): VBoxMachine parameters for every experiment
+        log_dir (str): directory where the VM log file is written
+
+    Returns:
+        list of dicts with the outcome of every experiment
+    """
+    sys.stdout = sys.stderr = LogFile(os.path.join(log_dir, '%s.log' % (vm_name,)))
+
+    results = []
+    ingesting = []
+    for vbox_params in experiments:
+        print('[#] Experiment with [%s] started @ %s' % (vbox_params['sample'], time.strftime('%Y-%m-%d %H:%M:%S')))
+        t0 = time.time()
+        result = {
+            'vm': vm_name,
+            'sample': os.path.basename(vbox_params['sample']),
+            'status': 'done',
+            'result_dir': '',
+            'error': ''
+        }
+        try:
+            vbx = VBoxMachine(**vbox_params)
+            result['result_dir'] = vbx.run() or ''
+            result['cached'] = vbx.cached
+            ingesting.append((result, vbx))
+        except Exception as e:
+            traceback.print_exc()
+            result['status'] = 'failed'
+            result['error'] = str(e).strip().split('\n')[0]
+        result['duration'] = time.time() - t0
+        results.append(result)
+
+    # the next experiments ran while the results were ingested
+    for result, vbx in ingesting:
+        status = vbx.wait_ingestion()
+        if status and status['status'] != 'done':
+            result['status'] = 'failed'
+            result['error'] = 'ingestion failed: %s' % (status.get('error'),)
+
+    return results
+
+
+def execute_parallel(vms, workers):
+    """Runs the experiments using a pool of worker processes. Every VM is driven by a single worker, so experiments
+    targeting the same VM are still executed one after another.
+
+    Args:
+        vms (list): VBoxMachine parameters for every experiment
+        workers (int): maximum number of VMs running at the same time
+
+    Returns:
+        list of dicts with the outcome of every experiment
+    """
+    groups = OrderedDict()
+    for vbox_params in vms:
+        groups.setdefault(vbox_params['name'], []).append(vbox_params)
+
+    if not os.path.isdir(LOGS_DIR):
+        os.makedirs(LOGS_DIR)
+
+    results = []
+    workers = max(1, min(workers, len(groups)))
+    print('[#] Running %d experiment(s) on %d VM(s) with %d worker(s)...' % (len(vms), len(groups), workers))
+
+    def finished(vm_results):
+        for r in vm_results:
+            print('[#] [%s] finished [%s] -> %s' % (r['vm'], r['sample'], r['status']), flush=True)
+
+    with multiprocessing.Pool(processes=workers, maxtasksperchild=1) as pool:
+        pending = OrderedDict()
+        for vm_name, experiments in groups.items():
+            pending[vm_name] = pool.apply_async(run_vm_experiments, (vm_name, experiments, LOGS_DIR),
+                    callback=finished)
+
+        for vm_name, async_result in pending.items():
+            try:
+                results.extend(async_result.get())
+            except Exception as e:
+                # the worker itself died, mark every experiment of the VM as failed
+                for vbox_params in groups[vm_name]:
+                    results.append({
+                        'vm': vm_name,
+                        'sample': os.path.basename(vbox_params['sample']),
+                        'status': 'failed',
+                        'result_dir': '',
+                        'error': 'worker error: %s' % (str(e).strip().split('\n')[0],),
+                        'duration': 0
+                    })
+
+    return results
+
+
+def print_summary(results, file=sys.stdout):
+    header = ('VM', 'Sample', 'Status', 'Duration', 'Result / error')
+    rows = []
+    for r in results:
+        rows.append((r['vm'], r['sample'], r['status'], '%.1fs' % (r['duration'],),
+                os.path.basename(r['result_dir']) + (' (cached)' if r.get('cached') else '') if r['status'] == 'done'
+                else r['error']))
+
+    widths = [max(len(str(row[i])) for row in rows + [header]) for i in range(len(header))]
+    line = '+'.join('-' * (w + 2) for w in widths)
+
+    print(line, file=file)
+    print('|'.join(' %s ' % (str(v).ljust(widths[i]),) for i, v in enumerate(header)), file=file)
+    print(line, file=file)
+    for row in rows:
+        print('|'.join(' %s ' % (str(v).ljust(widths[i]),) for i, v in enumerate(row)), file=file)
+    print(line, file=file)
+
+    failed = len([r for r in results if r['status'] != 'done'])
+    print('[#] %d experiment(s) done, %d failed.' % (len(results) - failed, failed), file=file)
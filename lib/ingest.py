@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import zipfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows host: the phases are only locked between the threads of a process
+    fcntl = None
+
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.resultcache import file_sha256
+from tools.common.timing import phase_percentiles
+
+# runs ingested at the same time
+INGEST_WORKERS = 4
+ARCHIVE_FN = 'results.zip'
+MANIFEST_FN = 'manifest.json'
+STATUS_FN = 'ingest.json'
+INDEX_FN = 'index.json'
+INFO_FN = 'info.json'
+TIMINGS_FN = 'timings.json'
+TRACE_FN = 'trace.json'
+GUEST_TIMINGS_FN = os.path.join('logs', 'timings.json')
+# not indexed: the archive and chunks as copied from the guest, the files written by the ingestion
+NOT_INDEXED = (ARCHIVE_FN, STATUS_FN, INDEX_FN, INFO_FN, TIMINGS_FN, TRACE_FN)
+NOT_INDEXED_DIRS = ('stream',)
+# phase durations of the latest runs and their percentiles, shown by the web interface
+PHASES_FN = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'cache', 'phases.json')
+PHASES_KEPT = 1000
+
+
+
+def ingestion_status(result_dir):
+    """Returns:
+        dict: ingestion status of a run (`ingest.json`) or None if the run was not ingested
+    """
+    try:
+        return json.loads(open(os.path.join(result_dir, STATUS_FN)).read())
+    except Exception:
+        return None
+
+
+def index_results(result_dir):
+    """Hashes every result file.
+
+    Returns:
+        list of dicts with the name (relative, `/` separated), size and SHA-256 of every file
+    """
+    index = []
+    for root, dirs, files in os.walk(result_dir):
+        if root == result_dir:
+            dirs[:] = [d for d in dirs if d not in NOT_INDEXED_DIRS]
+        for f in files:
+            path = os.path.join(root, f)
+            name = os.path.relpath(path, result_dir).replace(os.sep, '/')
+            if name in NOT_INDEXED:
+                continue
+            index.append({'name': name, 'size': os.path.getsize(path), 'sha256': file_sha256(path)})
+    return sorted(index, key=lambda entry: entry['name'])
+
+
+def check_manifest(result_dir, index):
+    """Checks the indexed files against the manifest written by clientapp.py.
+
+    Raises:
+        ValueError: the manifest is missing or unreadable (clientapp.py did not end, the results are incomplete)
+
+    Returns:
+        list of the names missing or with another size/hash than in the manifest
+    """
+    try:
+        manifest = json.loads(open(os.path.join(result_dir, MANIFEST_FN)).read())
+    except Exception as e:
+        raise ValueError('no readable manifest in the results (%s)' % (e,))
+    files = {entry['name']: entry for entry in index}
+    mismatched = []
+    for entry in manifest['files']:
+        indexed = files.get(entry['name'])
+        if not indexed or indexed['size'] != entry['size'] or indexed['sha256'] != entry.get('sha256',
+                indexed['sha256']):
+            mismatched.append(entry['name'])
+    return mismatched
+
+
+
+def merge_guest_timings(timings, result_dir):
+    """Adds the spans recorded by clientapp.py to the host ones. The guest clock is not the host one: the guest spans
+    are moved to start with the `client_app` span of the host.
+    """
+    try:
+        spans = json.loads(open(os.path.join(result_dir, GUEST_TIMINGS_FN)).read())['spans']
+    except Exception:
+        return
+    client_app = [span for span in timings.spans if span['name'] == 'client_app']
+    if spans and client_app:
+        timings.merge(spans, client_app[0]['start'] - min(span['start'] for span in spans))
+
+
+
+class Ingestor:
+    """Host side processing of the results of a run, done by a pool of worker threads so the VM can be powered off and
+    reused as soon as the results are copied from the guest.
+
+    A run is ingested by unpacking its archive, hashing the result files in `index.json` and checking them against the
+    manifest, writing the phases of the run (host and guest) in `timings.json`, then writing `info.json`, which marks
+    complete results (see ResultCache.lookup). The status of every run (queued, running, done or failed) is kept in
+    `ingest.json` in its result directory. Results without a manifest or not matching it fail and get no `info.json`,
+    so they are never served from the cache.
+    """
+
+
+    def __init__(self, workers=INGEST_WORKERS, phases_fn=PHASES_FN):
+        self.pool = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.phases_fn = phases_fn
+
+
+    def __write(self, result_dir, fn, data):
+        path = os.path.join(result_dir, fn)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(data, indent=4))
+        os.replace(tmp_path, path)
+
+
+    def __status(self, result_dir, status):
+        self.__write(result_dir, STATUS_FN, status)
+
+
+    def __record_phases(self, phases):
+        """Adds the phase durations of a run to the aggregate of the latest PHASES_KEPT runs and updates its
+        percentiles, so they are not computed again from every result. The aggregate is shared by the ingestors of all
+        the processes (--parallel, --farm), its updates are serialized by a lock file.
+        """
+        os.makedirs(os.path.dirname(self.phases_fn), exist_ok=True)
+        with self.lock, open(self.phases_fn + '.lock', 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                durations = json.loads(open(self.phases_fn).read())['durations']
+            except Exception:
+                durations = {}
+            for phase, duration in phases.items():
+                durations[phase] = (durations.get(phase, []) + [duration])[-PHASES_KEPT:]
+            self.__write(os.path.dirname(self.phases_fn), os.path.basename(self.phases_fn), {
+                'durations': durations,
+                'stats': phase_percentiles(durations)
+            })
+
+
+    def submit(self, result_dir, info, timings=None, trace=False):
+        """Queues the ingestion of a run.
+
+        Args:
+            result_dir (str): directory of the results, holding the archive copied from the guest (if not streamed)
+            info (dict): content of `info.json`
+            timings (Timings): host phases of the run
+            trace (bool): also export the phases as a Chrome trace (`trace.json`)
+
+        Returns:
+            Future: resolved with the final status of the ingestion
+        """
+        status = {'status': 'queued', 'queued': time.time()}
+        self.__status(result_dir, status)
+        future = self.pool.submit(self.ingest, result_dir, info, status, timings, trace)
+        with self.lock:
+            self.pending = [f for f in self.pending if not f.done()] + [future]
+        return future
+
+
+    def ingest(self, result_dir, info, status, timings=None, trace=False):
+        status.update({'status': 'running', 'started': time.time()})
+        self.__status(result_dir, status)
+        try:
+            archive_fn = os.path.join(result_dir, ARCHIVE_FN)
+            if os.path.isfile(archive_fn):
+                with zipfile.ZipFile(archive_fn, 'r') as zip_file:
+                    zip_file.extractall(result_dir)
+
+            index = index_results(result_dir)
+            self.__write(result_dir, INDEX_FN, {'files': index})
+            mismatched = check_manifest(result_dir, index)
+            if mismatched:
+                status['mismatched'] = mismatched
+                raise ValueError('results do not match their manifest: %s' % (', '.join(mismatched),))
+            if timings:
+                merge_guest_timings(timings, result_dir)
+                timings.add('ingest', status['started'], time.time())
+                self.__write(result_dir, TIMINGS_FN, timings.to_json())
+                if trace:
+                    self.__write(result_dir, TRACE_FN, timings.chrome_trace())
+            self.__write(result_dir, INFO_FN, info)
+
+            status.update({
+                'status': 'done',
+                'files': len(index),
+                'bytes': sum(entry['size'] for entry in index)
+            })
+        except Exception as e:
+            print('[!] ERROR: Ingesting [%s]: %s' % (result_dir, e))
+            status.update({'status': 'failed', 'error': str(e)})
+
+        # the results are complete once info.json is written, the statistics of the web interface don't change that
+        if timings and status['status'] == 'done':
+            try:
+                self.__record_phases(timings.phases())
+            except Exception as e:
+                print('[!] ERROR: Recording the phases of [%s]: %s' % (result_dir, e))
+        status['finished'] = time.time()
+        status['duration'] = status['finished'] - status['started']
+        self.__status(result_dir, status)
+        return status
+
+
+    def wait(self):
+        """Waits for all the queued runs to be ingested.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+
+
+INGESTOR = None
+INGESTOR_LOCK = threading.Lock()
+
+
+def default_ingestor():
+    """Returns:
+        Ingestor: pool shared by all the VMs driven from this process
+    """
+    global INGESTOR
+    with INGESTOR_LOCK:
+        if INGESTOR is None:
+            INGESTOR = Ingestor()
+        return INGESTOR
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+
+PROJECT_DIR = os.path.dirname(os.path.realpath(__file__)) + '/..'
+CACHE_DIR = os.path.join(PROJECT_DIR, 'cache', 'results')
+RESULTS_DIR = os.path.join(PROJECT_DIR, 'results')
+
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+
+class ResultCache:
+    """Maps already analyzed (sample, VM, snapshot, tools, options) combinations to their result directory.
+
+    Entries are stored as `<key>.json` files, the key being the SHA-256 of the sample hash, VM name, snapshot UUID,
+    tools bundle hash and options hash (the same sample run with other options has other results). The guest
+    architecture (which selects the tools bundle) of every snapshot is also remembered, so the key can be computed
+    before the VM is started.
+    """
+
+
+    def __init__(self, cache_dir=CACHE_DIR, results_dir=RESULTS_DIR):
+        self.cache_dir = cache_dir
+        self.results_dir = results_dir
+        self.architectures_fn = os.path.join(self.cache_dir, 'architectures.json')
+
+
+    def __write(self, fn, data):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+        with open(tmp_fn, 'w') as f:
+            f.write(json.dumps(data, indent=4))
+        os.replace(tmp_fn, fn)
+
+
+    def key(self, sample_hash, vm_name, snapshot_id, tools_hash, options_hash=''):
+        key = '\0'.join((sample_hash, vm_name, snapshot_id, tools_hash, options_hash))
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
+    def architecture(self, snapshot_id):
+        try:
+            return json.loads(open(self.architectures_fn).read()).get(snapshot_id)
+        except Exception:
+            return None
+
+
+    def set_architecture(self, snapshot_id, architecture):
+        try:
+            architectures = json.loads(open(self.architectures_fn).read())
+        except Exception:
+            architectures = {}
+        if architectures.get(snapshot_id) != architecture:
+            architectures[snapshot_id] = architecture
+            self.__write(self.architectures_fn, architectures)
+
+
+    def lookup(self, key):
+        """Returns:
+            str: path of the result directory or None if the key is unknown or its results were removed
+        """
+        try:
+            entry = json.loads(open(os.path.join(self.cache_dir, '%s.json' % (key,))).read())
+        except Exception:
+            return None
+
+        result_dir = os.path.join(self.results_dir, entry['result_dir'])
+        if not os.path.isfile(os.path.join(result_dir, 'info.json')):
+            return None
+        return result_dir
+
+
+    def store(self, key, result_dir, **info):
+        entry = {
+            'result_dir': os.path.basename(os.path.normpath(result_dir)),
+            'created': time.time()
+        }
+        entry.update(info)
+        self.__write(os.path.join(self.cache_dir, '%s.json' % (key,)), entry)
@@ -5,16 +5,102 @@ import sys
 import time
 import zipfile
 import json
+import hashlib
 
 from datetime import datetime
 
-import virtualbox
+try:
+    import virtualbox
+except ImportError:
+    virtualbox = None
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/..')
 
 from exception import VBoxLibException  # NOQA
+from lib.bundle import build_bundle, bundle_hash, VERSION_FN  # NOQA
+from lib.resultcache import ResultCache, file_sha256  # NOQA
+from lib.ingest import default_ingestor, MANIFEST_FN  # NOQA
+from tools.common.timing import Timings  # NOQA
 
 PROJECT_DIR = os.path.dirname(os.path.realpath(__file__)) + '/..'
+# seconds to wait for every type of VirtualBox operation
+OPERATION_TIMEOUTS = {
+    'launch_vm_process': 300,
+    'restore_snapshot': 300,
+    'power_off': 120,
+    'take_snapshot': 300,
+    'guest_ready': 300,
+    '__file_copy': 600,
+    # after the detonation, while streaming the results
+    'client_app': 1800,
+    'default': 600
+}
+# how often (seconds) the progress is reported while waiting for an operation
+PROGRESS_INTERVAL = 1
+# golden snapshots are named '<base snapshot>GOLDEN_SUFFIX<bundle hash>'
+GOLDEN_SUFFIX = '-golden-'
+# registry/process snapshots taken by clientapp.py before detonation, saved per online VM snapshot
+BASELINES_DIR = os.path.join(PROJECT_DIR, 'cache', 'baselines')
+RESULTS_DIR = os.path.join(PROJECT_DIR, 'results')
+BASELINE_FN = 'baseline.pickle'
+# with streaming, clientapp.py writes the results in chunks to this guest directory and the host pulls them every
+# STREAM_INTERVAL seconds into the `stream` directory of the results
+OUTBOX_DIR = 'outbox'
+STREAM_INTERVAL = 2
+CHUNK_INDEX_NAME = 'chunk.json'
+
+
+
+def get_backend(name=None):
+    """Returns the module implementing the VirtualBox API: `virtualbox` (default) or `mock` (see lib/vboxmock.py).
+    """
+    if name == 'mock':
+        import lib.vboxmock as vboxmock
+        return vboxmock
+    if virtualbox is None:
+        raise VBoxLibException('virtualbox module is not installed!')
+    return virtualbox
+
+
+def find_machine(backend, vbox, name):
+    try:
+        return vbox.find_machine(name)
+    except backend.library.VBoxErrorObjectNotFound:
+        raise VBoxLibException('Couldn\'t find [%s] VM in your VirtualBox environment' % (name,))
+
+
+def find_snapshot(backend, vm, name):
+    try:
+        return vm.find_snapshot(name or '')
+    except backend.library.VBoxErrorObjectNotFound as e:
+        raise VBoxLibException('VM has no snapshots or snapshot name is invalid!\nERROR: %s' % (str(e),))
+
+
+def find_golden_snapshot(snapshot):
+    """Searches for an up to date golden snapshot (see `VBoxMachine.prepare`) taken from the given snapshot.
+
+    Returns:
+        ISnapshot: the golden snapshot (online ones first) or None if no golden snapshot matches the current tools
+    """
+    golden = []
+    for child in snapshot.children:
+        if not child.name.startswith(snapshot.name + GOLDEN_SUFFIX):
+            continue
+        try:
+            info = json.loads(child.description)
+            if info['bundle_hash'] == bundle_hash(info['architecture']):
+                golden.append(child)
+                continue
+        except Exception:
+            pass
+        print('[!] Golden snapshot [%s] is outdated, run prepare again!' % (child.name,))
+
+    if not golden:
+        return None
+
+    # online snapshots are resumed instead of booted
+    golden.sort(key=lambda x: x.online, reverse=True)
+    return golden[0]
 
 
 
@@ -22,80 +108,262 @@ class VBoxMachine:
 
 
     def __init__(self, name, snapshot, username, password, sample, launch_type='headless', wait_time=30,
-            extraction_zip='extraction', sample_name='a'):
-        self.virtualbox = virtualbox.VirtualBox()
-        self.session = virtualbox.Session()
+            extraction_zip='extraction', sample_name='a', progress_callback=None, use_golden=True, backend=None,
+            adaptive_wait=False, min_wait=5, quiet_period=10, use_cache=True, compact_registry=False,
+            use_baseline=False, registry_notify=False, registry_check=False, capture_files=False,
+            suspend_all=False, hunter_full=False, procdump=False, procdump_limit=4, stream=False,
+            ingestor=None, trace=False):
+        self.backend = get_backend(backend)
+        self.virtualbox = self.backend.VirtualBox()
+        self.session = self.backend.Session()
 
         self.name = name
         self.username = username
         self.password = password
-        self.sample_path = os.path.normpath(os.path.join(PROJECT_DIR, sample) if not os.path.isabs(sample) else sample)
+        self.sample_path = None
+        if sample:
+            self.sample_path = os.path.normpath(os.path.join(PROJECT_DIR, sample) if not os.path.isabs(sample) else
+                    sample)
         self.sample_name = sample_name + '.exe'
         self.launch_type = launch_type
         self.wait_time = wait_time
+        self.adaptive_wait = adaptive_wait
+        self.min_wait = min_wait
+        self.quiet_period = quiet_period
+        self.compact_registry = compact_registry
+        self.use_baseline = use_baseline
+        self.registry_notify = registry_notify
+        self.registry_check = registry_check
+        self.capture_files = capture_files
+        self.suspend_all = suspend_all
+        self.hunter_full = hunter_full
+        self.procdump = procdump
+        self.procdump_limit = procdump_limit
+        self.stream = stream
+        self.chunks_pulled = 0
+        # the manifest is written last, in the final chunk
+        self.manifest_pulled = False
+        self.ingestor = ingestor or default_ingestor()
+        self.ingestion = None
+        # phases of the run, written with the guest ones in timings.json (and trace.json, a Chrome trace)
+        self.timings = Timings('host')
+        self.trace = trace
+        # SHA-256 of the baseline shipped to the guest, None without baseline
+        self.baseline_hash = None
+        self.cache = ResultCache()
+        self.use_cache = use_cache
+        self.cached = False
         self.extraction_fn = extraction_zip + '.zip'
         self.deploy_location = 'C:\\maltest'
         self.guest_session = None
         self.console_session = None
+        self.result_dir = None
+        self.progress_callback = progress_callback
+        self.bundle_hash = None
+        self.vm_architecture = None
 
-        try:
-            self.vm = self.virtualbox.find_machine(self.name)
-        except virtualbox.library.VBoxErrorObjectNotFound:
-            raise VBoxLibException('Couldn\'t find [%s] VM in your VirtualBox environment' % (self.name,))
-
-        try:
-            self.snapshot = self.vm.find_snapshot(snapshot or '')
-        except virtualbox.library.VBoxErrorObjectNotFound as e:
-            raise VBoxLibException('VM has no snapshots or snapshot name is invalid!\nERROR: %s' % (str(e),))
+        self.vm = find_machine(self.backend, self.virtualbox, self.name)
+        self.snapshot = find_snapshot(self.backend, self.vm, snapshot)
+        self.golden = self.find_golden_snapshot() if use_golden else None
 
-        if not os.path.isfile(self.sample_path):
+        if self.sample_path and not os.path.isfile(self.sample_path):
             raise VBoxLibException('Sample [%s] can\'t be found!' % (self.sample_path,))
 
         self.vm.create_session(session=self.session)
         self.session.unlock_machine()
 
 
-    def __wait_for_operation(self, op, message, status, show_progress=True):
+    def __wait_for_operation(self, op, message, progress, show_progress=True, timeout=None):
+        """Waits for a VirtualBox operation to complete. Returns as soon as the operation is completed.
+
+        Args:
+            op (str): operation name, selects the timeout from OPERATION_TIMEOUTS
+            message (str): message printed before waiting
+            progress (IProgress): progress object of the operation
+            show_progress (bool): print the completion percent
+            timeout (int): seconds to wait for the operation, overrides OPERATION_TIMEOUTS
+        """
         print(message, end='' if show_progress else '\n', flush=True)
+        timeout = timeout or OPERATION_TIMEOUTS.get(op, OPERATION_TIMEOUTS['default'])
+        deadline = time.time() + timeout
         last_status = -10
-        retries = 5
-        while status.percent < 100:
-            if status.percent - last_status > 9:
-                if show_progress:
-                    print('%s%%..' % (status.percent,), end='', flush=True)
-                last_status = status.percent
-            else:
-                if not retries:
-                    raise VBoxLibException('ERROR in [%s.__wait_for_operation] - exceeded operation retries' % (op,))
-                if status.percent == last_status:
-                    retries -= 1
-            time.sleep(0.5)
+        while not progress.completed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                try:
+                    if progress.cancelable:
+                        progress.cancel()
+                except Exception:
+                    pass
+                raise VBoxLibException('ERROR in [%s.__wait_for_operation] - operation timed out after %s sec.' %
+                        (op, timeout))
+
+            progress.wait_for_completion(int(min(remaining, PROGRESS_INTERVAL) * 1000))
+
+            percent = progress.percent
+            if self.progress_callback:
+                self.progress_callback(self.name, op, percent)
+            if show_progress and percent - last_status > 9 and percent < 100:
+                print('%s%%..' % (percent,), end='', flush=True)
+                last_status = percent
+
+        if progress.result_code:
+            try:
+                error = progress.error_info.text
+            except Exception:
+                error = 'result code %s' % (progress.result_code,)
+            raise VBoxLibException('ERROR in [%s.__wait_for_operation] - operation failed: %s' % (op, error))
+
+        if self.progress_callback:
+            self.progress_callback(self.name, op, 100)
         if show_progress:
             print('100%')
 
 
     def launch(self):
-        self.__wait_for_operation('launch_vm_process', '[#] Launching machine [%s]..' % (self.name,),
-                self.vm.launch_vm_process(self.session, self.launch_type))
+        snapshot = self.golden or self.snapshot
+        if snapshot.online:
+            message = '[#] Resuming machine [%s] from saved state..' % (self.name,)
+        else:
+            message = '[#] Launching machine [%s]..' % (self.name,)
+        self.__wait_for_operation('launch_vm_process', message, self.vm.launch_vm_process(self.session,
+                self.launch_type))
 
         self.console_session = self.session.console
-        try:
-            self.guest_session = self.console_session.guest.create_session(self.username, self.password)
-        except Exception:
-            raise VBoxLibException('Username or password are invalid for guest creation!')
+        with self.timings.span('guest_ready'):
+            self.__wait_for_guest()
 
         _, stdout, _ = self.__execute_command('proc_architecture', 'set|findstr /ic:PROCESSOR_ARCHITECTURE')
 
         self.vm_architecture = '64' if 'AMD64' in stdout.decode().upper() else '86'
 
 
+    def __wait_for_guest(self, timeout=None):
+        """Waits until a guest session can be created and used to execute commands. Right after resuming from an
+        online snapshot the guest is ready, while a booting guest needs its OS and Guest Additions started first.
+
+        Args:
+            timeout (int): seconds to wait for the guest, overrides OPERATION_TIMEOUTS
+        """
+        timeout = timeout or OPERATION_TIMEOUTS['guest_ready']
+        deadline = time.time() + timeout
+        run_levels = self.backend.library.AdditionsRunLevelType
+        t0 = time.time()
+        print('[#] Waiting for guest session on [%s]...' % (self.name,), end='', flush=True)
+        error = 'Guest Additions not started'
+        while time.time() < deadline:
+            try:
+                if self.console_session.guest.additions_run_level >= run_levels.userland:
+                    if self.guest_session is None:
+                        self.guest_session = self.console_session.guest.create_session(self.username,
+                                self.password)
+                    _, stdout, _ = self.guest_session.execute('cmd.exe', ['/c', 'echo', 'ready'])
+                    if b'ready' in stdout:
+                        print('%.1f sec.' % (time.time() - t0,))
+                        return
+                    error = 'guest command execution failed'
+            except Exception as e:
+                error = str(e)
+                self.guest_session = None
+            time.sleep(0.5)
+
+        print('')
+        raise VBoxLibException('Guest session on [%s] not ready after %s sec. (username or password may be invalid)!'
+                '\nERROR: %s' % (self.name, timeout, error))
+
+
+    def find_golden_snapshot(self):
+        golden = find_golden_snapshot(self.snapshot)
+        if golden:
+            print('[#] Using %s golden snapshot [%s] for [%s]' % ('online' if golden.online else 'offline',
+                    golden.name, self.name))
+        return golden
+
+
     def restore_snapshot(self):
-        self.vm.lock_machine(self.session, virtualbox.library.LockType(2))
-        self.__wait_for_operation('restore_snapshot', '[#] Restoring snapshot on [%s]..' % (self.name,),
-                self.session.machine.restore_snapshot(self.snapshot))
+        snapshot = self.golden or self.snapshot
+        self.vm.lock_machine(self.session, self.backend.library.LockType(2))
+        self.__wait_for_operation('restore_snapshot', '[#] Restoring snapshot [%s] on [%s]..' % (snapshot.name,
+                self.name), self.session.machine.restore_snapshot(snapshot))
         self.session.unlock_machine()
 
 
+    def __wait_for_unlock(self, timeout=30):
+        deadline = time.time() + timeout
+        while self.session.state == self.backend.library.SessionState.locked:
+            if time.time() > deadline:
+                raise VBoxLibException('ERROR in [__wait_for_unlock] - session of [%s] still locked' % (self.name,))
+            time.sleep(0.2)
+
+
+    def take_snapshot(self, name, description='', online=False):
+        """Takes a snapshot of the VM. An online snapshot is taken from the running VM and saves its execution
+        state, so launching it will resume the VM instead of booting it. Otherwise the VM has to be powered off.
+
+        Returns:
+            ISnapshot: the new snapshot
+        """
+        if online:
+            progress, snapshot_id = self.session.machine.take_snapshot(name, description, True)
+            self.__wait_for_operation('take_snapshot', '[#] Taking online snapshot [%s] of [%s]..' % (name,
+                    self.name), progress)
+            return self.vm.find_snapshot(snapshot_id)
+
+        self.__wait_for_unlock()
+        self.vm.lock_machine(self.session, self.backend.library.LockType(2))
+        try:
+            progress, snapshot_id = self.session.machine.take_snapshot(name, description, False)
+            self.__wait_for_operation('take_snapshot', '[#] Taking snapshot [%s] of [%s]..' % (name, self.name),
+                    progress)
+        finally:
+            self.session.unlock_machine()
+
+        return self.vm.find_snapshot(snapshot_id)
+
+
+    def prepare(self, online=False):
+        """Builds a golden snapshot of the VM: the selected snapshot with the tools already deployed and verified.
+        Experiments on the VM will restore the golden snapshot and copy only the sample.
+
+        Args:
+            online (bool): take the snapshot from the running VM (see `take_snapshot`)
+
+        Returns:
+            ISnapshot: the golden snapshot
+        """
+        self.golden = None
+        try:
+            self.restore_snapshot()
+            self.launch()
+            self.deploy_tools()
+            self.verify_tools()
+
+            name = '%s%s%s%s' % (self.snapshot.name, GOLDEN_SUFFIX, self.bundle_hash[:16],
+                    '-online' if online else '')
+            description = json.dumps({
+                'base_snapshot': self.snapshot.name,
+                'base_snapshot_id': self.snapshot.id_p,
+                'architecture': self.vm_architecture,
+                'bundle_hash': self.bundle_hash,
+                'deploy_location': self.deploy_location,
+                'created': datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
+            }, indent=4)
+            if online:
+                self.golden = self.take_snapshot(name, description, online=True)
+            self.power_off()
+        except VBoxLibException:
+            try:
+                self.power_off()
+            except Exception:
+                pass
+            raise
+
+        if not online:
+            self.golden = self.take_snapshot(name, description)
+
+        return self.golden
+
+
     def power_off(self):
         self.__wait_for_operation('power_off', '[#] Powering off [%s]..' % (self.name,),
                 self.console_session.power_down())
@@ -173,59 +441,374 @@ class VBoxMachine:
                 destination), self.__file_copy(source, destination, to_guest=False), show_progress=False)
 
 
-    def deploy_necessary_files(self):
-        print('[#] Copying necessary files on [%s]...' % (self.name,))
+    def deploy_tools(self):
+        print('[#] Copying tools on [%s]...' % (self.name,))
+        bundle_path, self.bundle_hash = build_bundle(self.vm_architecture)
         # create deploy directory
         self.__create_directory(self.deploy_location)
-        # copy sample
-        self.__copy_on_vm(self.sample_path, self.sample_name)
-        # copy tools directory
-        self.__copy_on_vm(os.path.join(PROJECT_DIR, 'tools', 'x%s' % (self.vm_architecture,)), 'tools')
-        # copy common tools files
-        self.__copy_on_vm(os.path.join(PROJECT_DIR, 'tools', 'common'), 'tools')
+        self.__create_directory(self.deploy_location + '\\tools')
+        # copy unzip and the tools bundle
+        self.__copy_on_vm(os.path.join(PROJECT_DIR, 'tools', 'x%s' % (self.vm_architecture,), 'unzip.exe'),
+                'tools\\unzip.exe')
+        self.__copy_on_vm(bundle_path, 'tools.zip')
 
         # unziping files
-        self.__unzip_tools()
+        with self.timings.span('unzip_tools'):
+            self.__unzip_tools()
+
+
+    def verify_tools(self):
+        print('[#] Verifying tools on [%s]...' % (self.name,))
+        tools_dir = self.deploy_location + '\\tools\\'
+        _, stdout, _ = self.__execute_command('verify_tools', 'type', ['%s%s' % (tools_dir, VERSION_FN)])
+        if stdout.decode(errors='ignore').strip() != self.bundle_hash:
+            raise VBoxLibException('Tools bundle on [%s] does not match [%s]!' % (self.name, self.bundle_hash))
+
+        _, stdout, _ = self.__execute_command('verify_tools', '%spython\\python.exe' % (tools_dir,), ['--version'])
+        if 'python' not in stdout.decode(errors='ignore').lower():
+            raise VBoxLibException('Python can\'t be executed on [%s]!' % (self.name,))
+
+
+    def deploy_necessary_files(self):
+        if self.golden:
+            # tools are already deployed in the golden snapshot
+            self.bundle_hash = json.loads(self.golden.description)['bundle_hash']
+        else:
+            self.deploy_tools()
+
+        self.baseline_hash = None
+        baseline_fn = self.baseline_path()
+        if baseline_fn:
+            self.baseline_hash = self.__stored_baseline(baseline_fn)
+            if self.baseline_hash:
+                print('[#] Copying baseline on [%s]...' % (self.name,))
+                self.__copy_on_vm(baseline_fn, BASELINE_FN)
+            else:
+                # before the sample is on the guest
+                with self.timings.span('capture_baseline'):
+                    self.baseline_hash = self.__capture_baseline(baseline_fn)
+
+        print('[#] Copying sample on [%s]...' % (self.name,))
+        with self.timings.span('copy_sample'):
+            self.__copy_on_vm(self.sample_path, self.sample_name)
+
+
+    def baseline_path(self):
+        """Host path of the baseline of the restored snapshot. The registry and processes of a guest resumed from an
+        online snapshot are the same on every run, so they are snapshotted only once; a booted guest differs from run
+        to run, so offline snapshots have no baseline.
+
+        Returns:
+            str: the path or None if baselines are not used for this run
+        """
+        snapshot = self.golden or self.snapshot
+        if not self.use_baseline or not snapshot.online:
+            return None
+        return os.path.join(BASELINES_DIR, '%s_%s%s.pickle' % (snapshot.id_p, self.bundle_hash[:16],
+                '_compact' if self.compact_registry else ''))
+
+
+    def __stored_baseline(self, baseline_fn):
+        """Returns:
+            str: SHA-256 of the stored baseline or None if there is none or it does not match the hash stored with it
+        """
+        if not os.path.isfile(baseline_fn) or not os.path.isfile(baseline_fn + '.sha256'):
+            return None
+        sha256 = open(baseline_fn + '.sha256').read().strip()
+        if file_sha256(baseline_fn) != sha256:
+            print('[!] Baseline [%s] does not match its hash, capturing it again' % (baseline_fn,), file=sys.stderr)
+            return None
+        return sha256
+
+
+    def __capture_baseline(self, baseline_fn):
+        """Runs clientapp.py in capture mode (no sample) to snapshot the guest registry and processes, and stores the
+        baseline on the host with its hash. The guest copy is then used by the experiment.
+
+        Returns:
+            str: SHA-256 of the baseline or None if it could not be captured
+        """
+        print('[#] Capturing baseline on [%s]...' % (self.name,))
+        tools_dir = self.deploy_location + '\\tools\\'
+        args = ['%sclientapp.py' % (tools_dir,), '-dd', self.deploy_location, '-cb', '-bl',
+                self.deploy_location + '\\' + BASELINE_FN] + (['-cr'] if self.compact_registry else [])
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        tmp_fn = '%s.%d.tmp' % (baseline_fn, os.getpid())
+        try:
+            process, _, _ = self.__execute_command('capture_baseline', tools_dir + 'python\\python.exe', args)
+            if process.exit_code:
+                raise VBoxLibException('clientapp.py ended with exit code %s' % (process.exit_code,))
+            self.copy_from_vm(self.deploy_location + '\\' + BASELINE_FN, tmp_fn)
+        except VBoxLibException as e:
+            print('[!] Baseline of [%s] could not be captured: %s' % (self.name, str(e)), file=sys.stderr)
+            if os.path.isfile(tmp_fn):
+                os.remove(tmp_fn)
+            return None
+
+        sha256 = file_sha256(tmp_fn)
+        with open(tmp_fn + '.sha256', 'w') as f:
+            f.write(sha256)
+        os.replace(tmp_fn, baseline_fn)
+        os.replace(tmp_fn + '.sha256', baseline_fn + '.sha256')
+        return sha256
 
 
     def __unzip_tools(self):
-        print('[#] Unzip python...')
+        print('[#] Unzip tools bundle...')
         tools_dir = self.deploy_location + '\\tools\\'
-        self.__execute_command('__unzip_tools', '%sunzip.exe' % (tools_dir,), ['%spython.zip' % (tools_dir,),
-                '-d', tools_dir])
+        self.__execute_command('__unzip_tools', '%sunzip.exe' % (tools_dir,), ['-q', '-o',
+                '%s\\tools.zip' % (self.deploy_location,), '-d', tools_dir])
 
 
-    def extract_archive(self):
-        results_dir = os.path.join(PROJECT_DIR, 'results')
+    def __create_result_dir(self):
+        results_dir = RESULTS_DIR
         datetime_now = datetime.now().strftime('%Y-%m-%d_%H:%M:%S')
         experiment_result_dir = os.path.join(results_dir, datetime_now)
-        os.makedirs(experiment_result_dir)
+        # parallel runs may finish in the same second
+        idx = 1
+        while 1:
+            try:
+                os.makedirs(experiment_result_dir)
+                break
+            except FileExistsError:
+                experiment_result_dir = os.path.join(results_dir, '%s_%d' % (datetime_now, idx))
+                idx += 1
+
+        self.result_dir = experiment_result_dir
 
-        zip_location = os.path.join(experiment_result_dir, 'results.zip')
+
+    def extract_archive(self):
+        """Copies the results archive from the guest, it is unpacked by the ingestion.
+        """
+        zip_location = os.path.join(self.result_dir, 'results.zip')
 
         self.copy_from_vm(self.deploy_location + '\\' + self.extraction_fn, zip_location)
 
-        zipfile.ZipFile(zip_location, 'r').extractall(experiment_result_dir)
-        with open(os.path.join(experiment_result_dir, 'info.json'), 'w') as f:
-            f.write(json.dumps({
-                'malware': self.sample_path,
-                'vm': self.name,
-                'vm_achitecture': self.vm_architecture,
-                'vm_username': self.username,
-                'vm_password': self.password
-            }))
 
+    def __extract_chunk(self, fn):
+        """Extracts a chunk of the results; segments of a file are appended to it.
+        """
+        with zipfile.ZipFile(fn, 'r') as zip_file:
+            index = json.loads(zip_file.read(CHUNK_INDEX_NAME).decode())
+            for entry in index['entries']:
+                if not entry.get('append_to'):
+                    zip_file.extract(entry['name'], self.result_dir)
+                    self.manifest_pulled |= entry['name'] == MANIFEST_FN
+                    continue
+                path = os.path.join(self.result_dir, *entry['append_to'].split('/'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'ab') as f:
+                    f.write(zip_file.read(entry['name']))
+
+
+    def pull_chunks(self):
+        """Copies the chunks sealed by clientapp.py since the last call into the `stream` directory of the results and
+        extracts them. Chunks are numbered, so they are pulled and extracted in order.
 
-    def launch_client_app(self):
-        print('[#] Launching clientapp.py on guest...')
-        python_path = self.deploy_location + '\\tools\\python\\python.exe'
-        tools_dir = self.deploy_location + '\\tools\\'
+        Returns:
+            int: number of pulled chunks
+        """
+        stream_dir = os.path.join(self.result_dir, 'stream')
+        os.makedirs(stream_dir, exist_ok=True)
+        pulled = 0
+        while 1:
+            name = 'chunk_%04d.zip' % (self.chunks_pulled,)
+            source = '%s\\%s\\%s' % (self.deploy_location, OUTBOX_DIR, name)
+            if not self.guest_session.file_exists(source, False):
+                return pulled
+            destination = os.path.join(stream_dir, name)
+            with self.timings.span('chunk_pull', chunk=self.chunks_pulled):
+                self.copy_from_vm(source, destination)
+                # frees the guest disk for the next dumps
+                self.guest_session.fs_obj_remove(source)
+                self.__extract_chunk(destination)
+            self.chunks_pulled += 1
+            pulled += 1
+
+
+    def __check_client_app(self, process):
+        """An uncaught exception ends clientapp.py with a non-zero exit code. Its traceback goes to the guest log, not
+        to stderr, and the results archive is still written, so a crashed run looks complete otherwise.
+        """
+        statuses = self.backend.library.ProcessStatus
+        if int(process.status) != int(statuses.terminated_normally) or process.exit_code:
+            raise VBoxLibException('ERROR in [launch_client_app] - clientapp.py ended abnormally (status: %s, exit '
+                    'code: %s), partial results in [%s]' % (process.status, process.exit_code, self.result_dir))
+
+
+    def __stream_client_app(self, cmd, args):
+        """Runs clientapp.py without waiting for it to end, pulling the chunks of results meanwhile. If the guest
+        hangs, the results pulled so far are kept.
+
+        A run which ended abnormally (see __check_client_app), or one whose final chunk (with the manifest) was not
+        pulled, fails.
+        """
+        statuses = self.backend.library.ProcessStatus
+        process = self.guest_session.process_create('cmd.exe', ['cmd.exe', '/c', cmd] + args, [], [], 0)
+        deadline = time.time() + self.wait_time + OPERATION_TIMEOUTS['client_app']
+        while int(process.status) < int(statuses.terminated_normally):
+            if time.time() > deadline:
+                self.pull_chunks()
+                raise VBoxLibException('ERROR in [launch_client_app] - clientapp.py still running after %s sec., %d '
+                        'chunks of results pulled in [%s]' % (self.wait_time + OPERATION_TIMEOUTS['client_app'],
+                        self.chunks_pulled, self.result_dir))
+            process.wait_for(int(self.backend.library.ProcessWaitForFlag.terminate), STREAM_INTERVAL * 1000)
+            self.pull_chunks()
+        self.pull_chunks()
+
+        self.__check_client_app(process)
+        if not self.manifest_pulled:
+            raise VBoxLibException('ERROR in [launch_client_app] - no manifest in the %d chunks of results pulled in '
+                    '[%s], the results are incomplete' % (self.chunks_pulled, self.result_dir))
+
+
+    def __ingest(self):
+        """Queues the host side processing of the results (see Ingestor), the VM is not needed for it.
+        """
+        self.ingestion = self.ingestor.submit(self.result_dir, {
+            'malware': self.sample_path,
+            'malware_sha256': file_sha256(self.sample_path),
+            'vm': self.name,
+            'snapshot': (self.golden or self.snapshot).name,
+            'vm_achitecture': self.vm_architecture,
+            'vm_username': self.username,
+            'vm_password': self.password
+        }, self.timings, self.trace)
+
+
+    def wait_ingestion(self):
+        """Returns:
+            dict: final ingestion status of the results or None if there is nothing to ingest (cached results)
+        """
+        return self.ingestion.result() if self.ingestion else None
+
+
+    def client_app_args(self):
+        """Returns:
+            list: arguments of clientapp.py for the options of the run, the baseline aside (it depends on the
+                baselines stored so far)
+        """
         args = [
             '-dd', self.deploy_location,
             '-sn', self.sample_name,
             '-wt', str(self.wait_time),
             '-zf', self.extraction_fn
         ]
-        self.__execute_command('launch_client_app', python_path, ['%sclientapp.py' % (tools_dir,)] + args)
+        if self.adaptive_wait:
+            args += ['-aw', '-mw', str(self.min_wait), '-qp', str(self.quiet_period)]
+        if self.compact_registry:
+            args.append('-cr')
+        if self.registry_notify:
+            args += ['-rn', '-rc'] if self.registry_check else ['-rn']
+        if self.capture_files:
+            args.append('-cf')
+        if self.suspend_all:
+            args.append('-sa')
+        if self.hunter_full:
+            args.append('-hf')
+        if self.procdump:
+            args += ['-pd', '-pl', str(self.procdump_limit)]
+        if self.stream:
+            args += ['-ob', self.deploy_location + '\\' + OUTBOX_DIR]
+        return args
+
+
+    def launch_client_app(self):
+        print('[#] Launching clientapp.py on guest...')
+        python_path = self.deploy_location + '\\tools\\python\\python.exe'
+        tools_dir = self.deploy_location + '\\tools\\'
+        args = self.client_app_args()
+        if self.baseline_hash:
+            args += ['-bl', self.deploy_location + '\\' + BASELINE_FN, '-bh', self.baseline_hash]
+        elif self.use_baseline and not self.baseline_path():
+            print('[!] Snapshot of [%s] is not online, baselines are not used' % (self.name,))
+        self.__create_result_dir()
+        self.chunks_pulled = 0
+        self.manifest_pulled = False
+        with self.timings.span('client_app'):
+            if self.stream:
+                self.__stream_client_app(python_path, ['%sclientapp.py' % (tools_dir,)] + args)
+            else:
+                process, _, _ = self.__execute_command('launch_client_app', python_path,
+                        ['%sclientapp.py' % (tools_dir,)] + args)
+
+        if not self.stream:
+            # the archive of a crashed run is still copied back, for its log
+            try:
+                with self.timings.span('copy_back'):
+                    self.extract_archive()
+            finally:
+                self.__check_client_app(process)
+
+
+    def cache_key(self):
+        """Key of the experiment in the result cache: sample hash, VM name, snapshot UUID, tools bundle hash and the
+        options of the run (arguments of clientapp.py).
+
+        Returns:
+            str: the key or None if the guest architecture (and so the tools bundle) is not known yet
+        """
+        snapshot = self.golden or self.snapshot
+        if self.golden:
+            architecture = json.loads(self.golden.description)['architecture']
+        else:
+            architecture = self.vm_architecture or self.cache.architecture(snapshot.id_p)
+        if architecture is None:
+            return None
+
+        options = self.client_app_args() + (['-bl'] if self.use_baseline else [])
+        return self.cache.key(file_sha256(self.sample_path), self.name, snapshot.id_p, bundle_hash(architecture),
+                hashlib.sha256('\0'.join(options).encode()).hexdigest())
+
+
+    def cached_result(self):
+        """Returns:
+            str: result directory of the same experiment in the cache or None if it was not run yet
+        """
+        key = self.cache_key()
+        return self.cache.lookup(key) if key else None
+
+
+    def run(self):
+        """Runs a full experiment on the VM: restore snapshot, launch, deploy, detonate and power off.
+
+        The VM is powered off even if one of the steps fails. If the sample was already analyzed on the same VM,
+        snapshot and tools, the cached results are returned instead (unless `use_cache` is off, in which case the new
+        results replace the cached ones). The results are still being ingested when this returns, see
+        `wait_ingestion`.
+
+        Returns:
+            str: path of the directory where the results were extracted
+        """
+        if self.use_cache:
+            result_dir = self.cached_result()
+            if result_dir:
+                print('[#] [%s] already analyzed on [%s], results: [%s]' % (os.path.basename(self.sample_path),
+                        self.name, result_dir))
+                self.result_dir = result_dir
+                self.cached = True
+                return self.result_dir
+
+        try:
+            with self.timings.span('restore_snapshot'):
+                self.restore_snapshot()
+            with self.timings.span('launch'):
+                self.launch()
+            with self.timings.span('deploy'):
+                self.deploy_necessary_files()
+            self.launch_client_app()
+            with self.timings.span('power_off'):
+                self.power_off()
+        except VBoxLibException:
+            try:
+                self.power_off()
+            except Exception:
+                pass
+            raise
+
+        # the VM is free from now on
+        self.__ingest()
+        self.cache.set_architecture((self.golden or self.snapshot).id_p, self.vm_architecture)
+        self.cache.store(self.cache_key(), self.result_dir, sample=os.path.basename(self.sample_path), vm=self.name)
 
-        self.extract_archive()
+        return self.result_dir
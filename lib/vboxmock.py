@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""Stand-in for the `virtualbox` module, used to run VBoxMachine without VirtualBox.
+
+Every mock machine keeps the guest file system in a temporary host directory (`C:\\a\\b` -> `<root>/C/a/b`) and
+snapshots keep a copy of it. Guest commands used by VBoxMachine are emulated; `clientapp.py` only produces an archive
+(or a chunk, when streaming) with empty logs and their manifest. Booting from a powered off snapshot takes BOOT_TIME
+seconds until the guest session can be created, while online snapshots are resumed instantly. Unknown machines are
+created on lookup, with a powered off snapshot named `base`.
+
+The machines only live in the process which created them (the snapshots taken, e.g. golden ones, are lost when it
+exits) and their temporary directories are removed at its exit.
+"""
+
+import os
+import time
+import atexit
+import json
+import uuid
+import hashlib
+import shutil
+import zipfile
+import tempfile
+import multiprocessing.util
+
+
+BOOT_TIME = 2
+MACHINES = {}
+# (PID, path) of the temporary directories; a forked worker inherits the list but removes only its own directories
+TEMP_DIRS = []
+
+
+
+def temp_dir(prefix):
+    path = tempfile.mkdtemp(prefix=prefix)
+    TEMP_DIRS.append((os.getpid(), path))
+    return path
+
+
+def remove_temp_dirs():
+    for pid, path in [d for d in TEMP_DIRS if d[0] == os.getpid()]:
+        shutil.rmtree(path, ignore_errors=True)
+        TEMP_DIRS.remove((pid, path))
+
+
+atexit.register(remove_temp_dirs)
+# the workers of a multiprocessing pool do not run the atexit handlers
+multiprocessing.util.Finalize(None, remove_temp_dirs, exitpriority=0)
+
+
+
+class library:
+
+
+    class VBoxError(Exception):
+        pass
+
+
+    class VBoxErrorObjectNotFound(VBoxError):
+        pass
+
+
+    class VBoxErrorInvalidVmState(VBoxError):
+        pass
+
+
+    class LockType(int):
+        pass
+
+
+    class SessionState:
+        unlocked = 1
+        locked = 2
+
+
+    class MachineState:
+        powered_off = 1
+        saved = 2
+        running = 5
+
+
+    class AdditionsRunLevelType:
+        none = 0
+        system = 1
+        userland = 2
+        desktop = 3
+
+
+    class GuestSessionWaitForFlag:
+        start = 1
+        terminate = 2
+
+
+    class ProcessWaitForFlag:
+        start = 1
+        terminate = 2
+
+
+    class ProcessStatus:
+        started = 100
+        terminated_normally = 500
+
+
+    class CloneMode:
+        machine_state = 1
+
+
+    class CloneOptions:
+        link = 1
+
+
+
+class Progress:
+
+
+    def __init__(self, duration=0, result_code=0, error=''):
+        self.end = time.time() + duration
+        self.duration = duration
+        self.result_code = result_code
+        self.cancelable = True
+        self.error_info = type('ErrorInfo', (), {'text': error})()
+
+
+    @property
+    def completed(self):
+        return time.time() >= self.end
+
+
+    @property
+    def percent(self):
+        if not self.duration:
+            return 100
+        return min(100, int(100 - (self.end - time.time()) * 100 / self.duration))
+
+
+    def wait_for_completion(self, timeout=-1):
+        remaining = self.end - time.time()
+        if remaining > 0:
+            time.sleep(remaining if timeout < 0 else min(remaining, timeout / 1000))
+
+
+    def cancel(self):
+        self.end = time.time()
+        self.result_code = 1
+        self.error_info.text = 'canceled'
+
+
+
+class Snapshot:
+
+
+    def __init__(self, machine, name, description='', online=False, parent=None):
+        self.machine = machine
+        self.name = name
+        self.description = description
+        self.online = online
+        self.parent = parent
+        self.children = []
+        self.id_p = str(uuid.uuid4())
+        self.fs = temp_dir('vboxmock_snapshot_')
+        if parent:
+            parent.children.append(self)
+
+
+
+class Machine:
+
+
+    def __init__(self, name, architecture='64', snapshot='base', online=False):
+        self.name = name
+        self.architecture = architecture
+        self.state = library.MachineState.powered_off
+        self.fs = temp_dir('vboxmock_%s_' % (name,))
+        self.root_snapshot = Snapshot(self, snapshot, online=online) if snapshot else None
+        self.current_snapshot = self.root_snapshot
+        self.booted_at = None
+        self.session = None
+
+
+    def __snapshots(self, snapshot=None):
+        snapshot = snapshot or self.root_snapshot
+        yield snapshot
+        for child in snapshot.children:
+            yield from self.__snapshots(child)
+
+
+    def find_snapshot(self, name_or_id):
+        if self.root_snapshot is None:
+            raise library.VBoxErrorObjectNotFound('This machine does not have any snapshots')
+        if not name_or_id:
+            return self.root_snapshot
+        for snapshot in self.__snapshots():
+            if name_or_id in (snapshot.name, snapshot.id_p):
+                return snapshot
+        raise library.VBoxErrorObjectNotFound('Could not find a snapshot named \'%s\'' % (name_or_id,))
+
+
+    def create_session(self, session=None):
+        session = session or Session()
+        self.lock_machine(session, library.LockType(1))
+        return session
+
+
+    def lock_machine(self, session, lock_type):
+        if self.session is not None:
+            raise library.VBoxError('The machine \'%s\' is already locked by a session' % (self.name,))
+        self.session = session
+        session.machine = self
+        session.state = library.SessionState.locked
+
+
+    def launch_vm_process(self, session, launch_type, environment_changes=''):
+        if self.state == library.MachineState.running:
+            raise library.VBoxErrorInvalidVmState('Machine \'%s\' is already running' % (self.name,))
+        self.booted_at = time.time() + (0 if self.state == library.MachineState.saved else BOOT_TIME)
+        self.state = library.MachineState.running
+        self.lock_machine(session, library.LockType(1))
+        session.console = Console(self)
+        return Progress()
+
+
+    def restore_snapshot(self, snapshot):
+        shutil.rmtree(self.fs)
+        shutil.copytree(snapshot.fs, self.fs)
+        self.current_snapshot = snapshot
+        self.state = library.MachineState.saved if snapshot.online else library.MachineState.powered_off
+        return Progress(0.2)
+
+
+    def take_snapshot(self, name, description, pause):
+        online = self.state == library.MachineState.running
+        snapshot = Snapshot(self, name, description, online, self.current_snapshot)
+        shutil.rmtree(snapshot.fs)
+        shutil.copytree(self.fs, snapshot.fs)
+        self.current_snapshot = snapshot
+        if self.root_snapshot is None:
+            self.root_snapshot = snapshot
+        return Progress(0.2), snapshot.id_p
+
+
+    def clone(self, snapshot_name_or_id=None, mode=None, options=None, name=None, uuid=None, groups=None,
+            basefolder='', register=True):
+        snapshot = snapshot_name_or_id
+        if not isinstance(snapshot, Snapshot):
+            snapshot = self.find_snapshot(snapshot) if snapshot else self.current_snapshot
+        name = name or '%s Clone' % (self.name,)
+        if name in MACHINES:
+            raise library.VBoxError('Machine \'%s\' already exists' % (name,))
+        clone = Machine(name, self.architecture, snapshot=None)
+        shutil.rmtree(clone.fs)
+        shutil.copytree(snapshot.fs, clone.fs)
+        MACHINES[name] = clone
+        return clone
+
+
+    def remove(self, delete=True):
+        if self.state == library.MachineState.running:
+            Console(self).power_down()
+        MACHINES.pop(self.name, None)
+        shutil.rmtree(self.fs, ignore_errors=True)
+        return []
+
+
+
+class Session:
+
+
+    def __init__(self):
+        self.state = library.SessionState.unlocked
+        self.machine = None
+        self.console = None
+
+
+    def unlock_machine(self):
+        if self.machine is not None:
+            self.machine.session = None
+        self.state = library.SessionState.unlocked
+        self.machine = None
+
+
+
+class Console:
+
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.guest = Guest(machine)
+
+
+    def power_down(self):
+        self.machine.state = library.MachineState.powered_off
+        self.machine.booted_at = None
+        if self.machine.session is not None:
+            self.machine.session.unlock_machine()
+        return Progress(0.2)
+
+
+
+class Guest:
+
+
+    def __init__(self, machine):
+        self.machine = machine
+
+
+    @property
+    def additions_run_level(self):
+        if self.machine.booted_at is None or time.time() < self.machine.booted_at:
+            return library.AdditionsRunLevelType.none
+        return library.AdditionsRunLevelType.desktop
+
+
+    def create_session(self, user, password, domain='', session_name='pyvbox', timeout_ms=0):
+        if self.additions_run_level < library.AdditionsRunLevelType.userland:
+            raise SystemError('GuestSession failed to start')
+        if not password:
+            raise SystemError('GuestSession failed to start. Could be because of using an empty password.')
+        return GuestSession(self.machine)
+
+
+
+class GuestProcess:
+
+
+    def __init__(self, stdout=b'', stderr=b''):
+        self.status = library.ProcessStatus.terminated_normally
+        self.exit_code = 0
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+    def wait_for(self, wait_for, timeout_ms):
+        return wait_for
+
+
+
+class GuestSession:
+
+
+    def __init__(self, machine):
+        self.machine = machine
+
+
+    def __host_path(self, path):
+        drive, rest = path.split(':', 1)
+        return os.path.join(self.machine.fs, drive.upper(), *[p for p in rest.split('\\') if p])
+
+
+    def __run(self, command, arguments):
+        name = command.split('\\')[-1].lower()
+        if name == 'cmd.exe' and arguments[:1] == ['/c']:
+            return self.__run(arguments[1], arguments[2:])
+        if name.startswith('set|findstr'):
+            return b'PROCESSOR_ARCHITECTURE=%s\r\n' % (b'AMD64' if self.machine.architecture == '64' else b'x86',)
+        if name == 'echo':
+            return ' '.join(arguments).encode() + b'\r\n'
+        if name == 'type':
+            return open(self.__host_path(arguments[0]), 'rb').read()
+        if name == 'unzip.exe':
+            args = [a for a in arguments if not a.startswith('-') or a == '-d']
+            destination = args[args.index('-d') + 1]
+            zipfile.ZipFile(self.__host_path(args[0])).extractall(self.__host_path(destination))
+            return b''
+        if name == 'python.exe' and '--version' in arguments:
+            return b'Python 3.7.0\r\n'
+        if name == 'python.exe' and arguments and arguments[0].lower().endswith('clientapp.py'):
+            args = {}
+            for idx, arg in enumerate(arguments[1:], 1):
+                if arg.startswith('-'):
+                    nxt = arguments[idx + 1] if idx + 1 < len(arguments) else ''
+                    args[arg] = nxt if not nxt.startswith('-') else ''
+            if '-cb' in args:
+                with open(self.__host_path(args['-bl']), 'wb') as f:
+                    f.write(b'baseline')
+                return b''
+            zip_fn = self.__host_path(args['-dd'] + '\\' + args['-zf'])
+            if args.get('-ob'):
+                # a single chunk in the outbox
+                os.makedirs(self.__host_path(args['-ob']), exist_ok=True)
+                zip_fn = self.__host_path(args['-ob'] + '\\chunk_0000.zip')
+            with zipfile.ZipFile(zip_fn, 'w') as zip_file:
+                manifest = []
+                for f in ('clientapp.log', 'folder_changes.txt', 'registry_changes.txt'):
+                    zip_file.writestr('logs/' + f, '')
+                    manifest.append({'name': 'logs/' + f, 'size': 0, 'compressed_size': 0,
+                            'sha256': hashlib.sha256(b'').hexdigest()})
+                zip_file.writestr('manifest.json', json.dumps({'files': manifest}, indent=4))
+                if args.get('-ob'):
+                    manifest.append({'name': 'manifest.json'})
+                    zip_file.writestr('chunk.json', json.dumps({'chunk': 0, 'entries': manifest}, indent=4))
+            return b''
+        return b''
+
+
+    def execute(self, command, arguments=None, stdin='', environment=None, flags=None, priority=None,
+            affinity=None, timeout_ms=0):
+        process = GuestProcess(self.__run(command, list(arguments or [])))
+        return process, process.stdout, process.stderr
+
+
+    def process_create(self, executable, arguments, environment_changes, flags, timeout_ms):
+        # arguments start with argv[0]
+        return GuestProcess(self.__run(executable, list(arguments[1:])))
+
+
+    def directory_create(self, path, mode, flags):
+        os.makedirs(self.__host_path(path), exist_ok=True)
+
+
+    def directory_exists(self, path, follow_symlinks=True):
+        return os.path.isdir(self.__host_path(path))
+
+
+    def file_exists(self, path, follow_symlinks=True):
+        return os.path.isfile(self.__host_path(path))
+
+
+    def file_copy_to_guest(self, source, destination, flags):
+        if not os.path.isdir(os.path.dirname(self.__host_path(destination))):
+            return Progress(result_code=1, error='No such file or directory on guest: %s' % (destination,))
+        shutil.copyfile(source, self.__host_path(destination))
+        return Progress()
+
+
+    def file_copy_from_guest(self, source, destination, flags):
+        if not os.path.isfile(self.__host_path(source)):
+            return Progress(result_code=1, error='No such file or directory on guest: %s' % (source,))
+        shutil.copyfile(self.__host_path(source), destination)
+        return Progress()
+
+
+    def fs_obj_remove(self, path):
+        os.remove(self.__host_path(path))
+
+
+    def close(self):
+        pass
+
+
+
+class VirtualBox:
+
+
+    @property
+    def machines(self):
+        return list(MACHINES.values())
+
+
+    def find_machine(self, name_or_id):
+        if name_or_id not in MACHINES:
+            MACHINES[name_or_id] = Machine(name_or_id)
+        return MACHINES[name_or_id]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/..')
+
+from exception import VBoxLibException  # NOQA
+from lib.vboxmachine import get_backend, find_machine, find_snapshot, find_golden_snapshot, \
+        OPERATION_TIMEOUTS  # NOQA
+
+
+
+class VMFarm:
+    """Linked clones of one base VM snapshot, used as interchangeable workers.
+
+    Every clone gets a snapshot with the same name as the base snapshot, so it can be used as the VM of an experiment
+    exactly like the base VM. If the base snapshot has an up to date golden snapshot, the clones are created from it
+    and get a golden snapshot too.
+    """
+
+
+    def __init__(self, base_name, snapshot=None, prefix=None, backend=None):
+        self.backend = get_backend(backend)
+        self.virtualbox = self.backend.VirtualBox()
+        self.base = find_machine(self.backend, self.virtualbox, base_name)
+        self.snapshot = find_snapshot(self.backend, self.base, snapshot)
+        self.golden = find_golden_snapshot(self.snapshot)
+        self.prefix = prefix or '%s-clone-' % (base_name,)
+        self.clones = []
+
+
+    def __wait(self, op, progress):
+        progress.wait_for_completion(OPERATION_TIMEOUTS.get(op, OPERATION_TIMEOUTS['default']) * 1000)
+        if not progress.completed or progress.result_code:
+            raise VBoxLibException('ERROR in [%s] - operation failed or timed out' % (op,))
+
+
+    def __take_snapshot(self, machine, name, description):
+        session = self.backend.Session()
+        machine.lock_machine(session, self.backend.library.LockType(2))
+        try:
+            progress, _ = session.machine.take_snapshot(name, description, False)
+            self.__wait('take_snapshot', progress)
+        finally:
+            session.unlock_machine()
+
+
+    def __find_clone(self, name):
+        for machine in self.virtualbox.machines:
+            if machine.name == name:
+                return machine
+        return None
+
+
+    def clone_name(self, idx):
+        return '%s%d' % (self.prefix, idx)
+
+
+    def create_clone(self, name):
+        source = self.golden or self.snapshot
+        print('[#] Creating linked clone [%s] of [%s] from [%s]...' % (name, self.base.name, source.name))
+        clone = self.base.clone(snapshot_name_or_id=source, mode=self.backend.library.CloneMode.machine_state,
+                options=[self.backend.library.CloneOptions.link], name=name)
+
+        self.__take_snapshot(clone, self.snapshot.name, self.snapshot.description)
+        if self.golden:
+            self.__take_snapshot(clone, self.golden.name, self.golden.description)
+
+        return clone
+
+
+    def create(self, count):
+        """Creates (or reuses, if they are already registered) `count` clones.
+
+        Returns:
+            list: names of the clones
+        """
+        for idx in range(1, count + 1):
+            name = self.clone_name(idx)
+            if name in self.clones:
+                continue
+            if self.__find_clone(name) is None:
+                self.create_clone(name)
+            else:
+                print('[#] Reusing linked clone [%s]' % (name,))
+            self.clones.append(name)
+
+        return list(self.clones)
+
+
+    def remove_clone(self, name):
+        clone = self.__find_clone(name)
+        if clone is not None:
+            print('[#] Removing linked clone [%s]...' % (name,))
+            clone.remove(delete=True)
+        if name in self.clones:
+            self.clones.remove(name)
+
+
+    def recycle(self, name):
+        """Replaces a clone with a fresh one, e.g. after it got into a broken state.
+        """
+        self.remove_clone(name)
+        self.create_clone(name)
+        self.clones.append(name)
+
+
+    def teardown(self):
+        for name in list(self.clones):
+            try:
+                self.remove_clone(name)
+            except Exception as e:
+                print('[!] ERROR: could not remove [%s]: %s' % (name, str(e)), file=sys.stderr)
+
+
+    def workers(self):
+        """VM definitions of the clones, same keys as the VMs of a configuration file.
+        """
+        return [{'name': name, 'snapshot': self.snapshot.name} for name in self.clones]
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Runs the host side of the pipeline (VBoxMachine, ingestion, result cache) against the mock VirtualBox backend."""
+
+import os
+import sys
+import json
+import subprocess
+import multiprocessing
+
+import pytest
+
+PROJECT_DIR = os.path.dirname(os.path.realpath(__file__)) + '/..'
+sys.path.insert(0, PROJECT_DIR)
+
+import lib.vboxmock as vboxmock  # NOQA
+import lib.vboxmachine as vboxmachine  # NOQA
+from lib.ingest import Ingestor  # NOQA
+from lib.resultcache import ResultCache  # NOQA
+from tools.common.timing import Timings  # NOQA
+
+
+SAMPLE = 'malware/unknown/795DFF200AB0B33D0C79DB8F33D87209.sample'
+
+
+
+@pytest.fixture(autouse=True)
+def mock_env(tmp_path, monkeypatch):
+    """Fresh mock machines, results, baselines and cache in a temporary directory."""
+    monkeypatch.setattr(vboxmock, 'MACHINES', {})
+    monkeypatch.setattr(vboxmock, 'BOOT_TIME', 0.5)
+    monkeypatch.setattr(vboxmachine, 'RESULTS_DIR', str(tmp_path / 'results'))
+    monkeypatch.setattr(vboxmachine, 'BASELINES_DIR', str(tmp_path / 'baselines'))
+    monkeypatch.setattr(vboxmachine, 'ResultCache', lambda: ResultCache(str(tmp_path / 'cache'),
+            str(tmp_path / 'results')))
+    return tmp_path
+
+
+def machine(tmp_path, **kwargs):
+    kwargs.setdefault('wait_time', 1)
+    return vboxmachine.VBoxMachine('m1', 'base', 'user', 'password', SAMPLE, backend='mock',
+            ingestor=Ingestor(phases_fn=str(tmp_path / 'phases.json')), **kwargs)
+
+
+def test_run(mock_env):
+    vbx = machine(mock_env)
+    result_dir = vbx.run()
+    status = vbx.wait_ingestion()
+
+    assert status['status'] == 'done'
+    assert not vbx.cached
+    for fn in ('info.json', 'index.json', 'manifest.json', 'timings.json', os.path.join('logs', 'clientapp.log')):
+        assert os.path.isfile(os.path.join(result_dir, fn))
+    info = json.loads(open(os.path.join(result_dir, 'info.json')).read())
+    assert info['vm'] == 'm1' and info['vm_achitecture'] == '64'
+    phases = json.loads(open(os.path.join(result_dir, 'timings.json')).read())['phases']
+    assert {'restore_snapshot', 'launch', 'deploy', 'client_app', 'power_off', 'ingest'} <= set(phases)
+    assert vboxmock.MACHINES['m1'].state == vboxmock.library.MachineState.powered_off
+
+
+def test_run_stream(mock_env):
+    vbx = machine(mock_env, stream=True)
+    result_dir = vbx.run()
+
+    assert vbx.wait_ingestion()['status'] == 'done'
+    assert vbx.chunks_pulled == 1
+    assert os.path.isfile(os.path.join(result_dir, 'stream', 'chunk_0000.zip'))
+    assert os.path.isfile(os.path.join(result_dir, 'manifest.json'))
+
+
+def test_run_cached(mock_env):
+    vbx = machine(mock_env)
+    result_dir = vbx.run()
+    vbx.wait_ingestion()
+
+    cached = machine(mock_env)
+    assert cached.run() == result_dir
+    assert cached.cached
+    # other options, other results
+    assert machine(mock_env, procdump=True).cached_result() is None
+    assert machine(mock_env, wait_time=2).cached_result() is None
+    assert machine(mock_env, use_cache=False).run() != result_dir
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_run_crashed(mock_env, monkeypatch, stream):
+    create = vboxmock.GuestProcess.__init__
+
+    def crashed(self, *args, **kwargs):
+        create(self, *args, **kwargs)
+        self.exit_code = 1
+    monkeypatch.setattr(vboxmock.GuestProcess, '__init__', crashed)
+    vbx = machine(mock_env, stream=stream)
+
+    with pytest.raises(vboxmachine.VBoxLibException, match='ended abnormally'):
+        vbx.run()
+    assert vbx.cached_result() is None
+
+
+@pytest.mark.parametrize('online', [False, True])
+def test_prepare_golden_snapshot(mock_env, online):
+    golden = machine(mock_env, use_golden=False).prepare(online=online)
+
+    assert golden.online == online
+    assert json.loads(golden.description)['architecture'] == '64'
+    vbx = machine(mock_env)
+    assert vbx.golden is golden
+    vbx.run()
+    assert vbx.wait_ingestion()['status'] == 'done'
+    # only the sample is copied on a golden snapshot
+    assert 'unzip_tools' not in vbx.timings.phases()
+    assert ('guest_ready' in vbx.timings.phases()) and (vbx.timings.phases()['guest_ready'] < 0.5) == online
+
+
+def test_baseline(mock_env):
+    machine(mock_env, use_golden=False).prepare(online=True)
+    vbx = machine(mock_env, use_baseline=True, use_cache=False)
+    vbx.run()
+    baseline_fn = vbx.baseline_path()
+
+    assert vbx.wait_ingestion()['status'] == 'done'
+    assert 'capture_baseline' in vbx.timings.phases()
+    assert open(baseline_fn + '.sha256').read() == vbx.baseline_hash
+    # shipped, not captured again
+    vbx = machine(mock_env, use_baseline=True, use_cache=False)
+    vbx.run()
+    assert 'capture_baseline' not in vbx.timings.phases()
+    # a baseline not matching its hash is captured again
+    with open(baseline_fn, 'ab') as f:
+        f.write(b'planted')
+    vbx = machine(mock_env, use_baseline=True, use_cache=False)
+    vbx.run()
+    assert 'capture_baseline' in vbx.timings.phases()
+    assert open(baseline_fn, 'rb').read() == b'baseline'
+
+
+def ingest_runs(result_dir, phases_fn, runs):
+    os.makedirs(result_dir)
+    with open(os.path.join(result_dir, 'manifest.json'), 'w') as f:
+        f.write(json.dumps({'files': []}))
+    ingestor = Ingestor(phases_fn=phases_fn)
+    for _ in range(runs):
+        timings = Timings()
+        timings.add('client_app', 0, 1)
+        assert ingestor.ingest(result_dir, {}, {}, timings)['status'] == 'done'
+
+
+def test_phases_recorded_by_processes(mock_env):
+    phases_fn = str(mock_env / 'phases.json')
+    processes = [multiprocessing.Process(target=ingest_runs, args=(str(mock_env / str(idx)), phases_fn, 50))
+            for idx in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert all(process.exitcode == 0 for process in processes)
+    assert len(json.loads(open(phases_fn).read())['durations']['client_app']) == 200
+
+
+def test_temp_dirs_removed(mock_env):
+    machine(mock_env)
+    dirs = [path for pid, path in vboxmock.TEMP_DIRS if pid == os.getpid()]
+    assert dirs and all(os.path.isdir(path) for path in dirs)
+
+    vboxmock.remove_temp_dirs()
+    assert not any(os.path.exists(path) for path in dirs)
+
+
+def test_prepare_rejected_with_mock():
+    process = subprocess.run([sys.executable, os.path.join(PROJECT_DIR, 'app.py'), '--prepare', '--mock', '-vm', 'm1',
+            '-u', 'user', '-p', 'password'], cwd=PROJECT_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    assert process.returncode == 2
+    assert b'--mock' in process.stderr
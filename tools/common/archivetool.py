@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import zipfile
+import threading
+
+
+# bytes read at once when a file is added
+CHUNK_SIZE = 1 << 20
+# logs and reports, small and compressing well
+TEXT_EXTENSIONS = ('.txt', '.log', '.json', '.csv', '.xml', '.tag')
+TEXT_LEVEL = 9
+# memory dumps and captured files, large and written while the run ends
+FAST_LEVEL = 1
+# signatures of data which is already compressed (zip/office, gzip, 7z, rar, cab, bzip2, xz, zstd, png, jpeg, gif)
+COMPRESSED_MAGICS = (b'PK\x03\x04', b'\x1f\x8b', b'7z\xbc\xaf\x27\x1c', b'Rar!', b'MSCF', b'BZh', b'\xfd7zXZ',
+        b'\x28\xb5\x2f\xfd', b'\x89PNG', b'\xff\xd8\xff', b'GIF8')
+MANIFEST_NAME = 'manifest.json'
+# in outbox mode, a chunk is sealed once it holds this many (uncompressed) bytes
+OUTBOX_CHUNK_BYTES = 32 << 20
+CHUNK_INDEX_NAME = 'chunk.json'
+# seconds between two flushes of the streamed logs
+STREAM_INTERVAL = 5
+
+
+
+def compression(arcname, head):
+    """Chooses the compression of an entry from its name and first bytes.
+
+    Returns:
+        tuple of (compress type, compress level)
+    """
+    if arcname.lower().endswith(TEXT_EXTENSIONS):
+        return zipfile.ZIP_DEFLATED, TEXT_LEVEL
+    if head.startswith(COMPRESSED_MAGICS):
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, FAST_LEVEL
+
+
+
+class ResultArchive():
+    """Extraction archive, written by the monitoring threads while the experiment runs.
+
+    Every entry is compressed according to its type (see `compression`) and recorded with its size and SHA-256 in
+    `manifest.json`, written when the archive is closed.
+
+    With an outbox directory, the entries are written in a series of chunks (`chunk_<n>.zip`) instead of a single
+    archive, so the host can pull them while the experiment runs. A chunk is sealed (renamed from `.part`, so the host
+    never copies a partial chunk) on `flush` or once it reaches OUTBOX_CHUNK_BYTES. Every chunk lists its entries in
+    `chunk.json`; entries added with `append` are segments to be appended to their file.
+    """
+
+
+    def __init__(self, fn, outbox=None):
+        self.fn = fn
+        self.outbox = outbox
+        self.zip = zipfile.ZipFile(fn, 'a') if not outbox else None
+        self.lock = threading.Lock()
+        self.manifest = []
+        # outbox mode: sealed chunks, entries and bytes of the current chunk, [size, SHA-256] of the appended files
+        self.chunks = 0
+        self.chunk = []
+        self.chunk_bytes = 0
+        self.appended = {}
+        if outbox:
+            os.makedirs(outbox, exist_ok=True)
+
+
+    def __chunk_fn(self):
+        return os.path.join(self.outbox, 'chunk_%04d.zip' % (self.chunks,))
+
+
+    def __open(self, arcname, head):
+        if self.zip is None:
+            self.zip = zipfile.ZipFile(self.__chunk_fn() + '.part', 'w')
+        # entries opened by name get the compression of the archive
+        self.zip.compression, self.zip.compresslevel = compression(arcname, head)
+        return self.zip.open(arcname, 'w', force_zip64=True)
+
+
+    def __record(self, arcname, sha256, append_to=None):
+        info = self.zip.getinfo(arcname)
+        entry = {
+            'name': arcname.replace('\\', '/'),
+            'size': info.file_size,
+            'compressed_size': info.compress_size,
+            'sha256': sha256.hexdigest()
+        }
+        if not self.outbox:
+            self.manifest.append(entry)
+            return
+        if append_to:
+            entry['append_to'] = append_to.replace('\\', '/')
+        else:
+            self.manifest.append(entry)
+        self.chunk.append(entry)
+        self.chunk_bytes += info.file_size
+        if self.chunk_bytes >= OUTBOX_CHUNK_BYTES:
+            self.__seal()
+
+
+    def __seal(self):
+        self.zip.writestr(CHUNK_INDEX_NAME, json.dumps({'chunk': self.chunks, 'entries': self.chunk}, indent=4))
+        self.zip.close()
+        os.replace(self.__chunk_fn() + '.part', self.__chunk_fn())
+        self.zip = None
+        self.chunks += 1
+        self.chunk = []
+        self.chunk_bytes = 0
+
+
+    def write(self, path, arcname):
+        """Adds a file, reading it once to compress and hash it.
+        """
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as src, self.lock:
+            chunk = src.read(CHUNK_SIZE)
+            with self.__open(arcname, chunk) as dst:
+                while chunk:
+                    sha256.update(chunk)
+                    dst.write(chunk)
+                    chunk = src.read(CHUNK_SIZE)
+            self.__record(arcname, sha256)
+
+
+    def writestr(self, arcname, data):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.lock:
+            with self.__open(arcname, data[:CHUNK_SIZE]) as dst:
+                dst.write(data)
+            self.__record(arcname, hashlib.sha256(data))
+
+
+    def append(self, arcname, data):
+        """Outbox mode: adds a segment of a file written while the experiment runs (e.g. a log), the host appends the
+        segments of a file in the order they were added.
+        """
+        with self.lock:
+            appended = self.appended.setdefault(arcname, [0, hashlib.sha256()])
+            # segments are named after their offset in the file
+            segment = '%s.%d' % (arcname, appended[0])
+            with self.__open(segment, data[:CHUNK_SIZE]) as dst:
+                dst.write(data)
+            appended[0] += len(data)
+            appended[1].update(data)
+            self.__record(segment, hashlib.sha256(data), append_to=arcname)
+
+
+    def flush(self):
+        """Outbox mode: seals the current chunk.
+        """
+        with self.lock:
+            if self.outbox and self.chunk:
+                self.__seal()
+
+
+    def move(self, path, arcname):
+        """Adds a file and removes it from the disk.
+        """
+        self.write(path, arcname)
+        os.remove(path)
+
+
+    def move_tree(self, root, prefix):
+        """Adds the files under a directory (`<prefix>\\<relative path>`) and removes them from the disk.
+        """
+        for dirpath, _, files in os.walk(root):
+            for f in files:
+                path = os.path.join(dirpath, f)
+                self.move(path, prefix + '\\' + os.path.relpath(path, root))
+
+
+    def close(self):
+        files = self.manifest + [{'name': arcname.replace('\\', '/'), 'size': size, 'sha256': sha256.hexdigest()}
+                for arcname, (size, sha256) in self.appended.items()]
+        manifest = json.dumps({'files': files}, indent=4).encode()
+        with self.lock:
+            with self.__open(MANIFEST_NAME, manifest) as dst:
+                dst.write(manifest)
+            if self.outbox:
+                self.__record(MANIFEST_NAME, hashlib.sha256(manifest))
+                self.__seal()
+            else:
+                self.zip.close()
+
+
+
+class LogStreamer(threading.Thread):
+    """Outbox mode: appends the lines added to the given files to the archive every STREAM_INTERVAL seconds and seals
+    the current chunk, so the logs and the artifacts archived meanwhile reach the host while the experiment runs.
+    """
+
+
+    def __init__(self, archive, files, interval=STREAM_INTERVAL):
+        super().__init__(daemon=True)
+        self.archive = archive
+        # path -> arcname
+        self.files = files
+        self.interval = interval
+        self.offsets = dict.fromkeys(files, 0)
+        self.stopped = threading.Event()
+
+
+    def __stream(self, path, complete=False):
+        try:
+            with open(path, 'rb') as f:
+                f.seek(self.offsets[path])
+                data = f.read()
+        except Exception:
+            return
+        if not complete:
+            # lines still being written are sent with the next flush
+            data = data[:data.rfind(b'\n') + 1]
+        if data:
+            self.archive.append(self.files[path], data)
+            self.offsets[path] += len(data)
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for path in self.files:
+                self.__stream(path)
+            self.archive.flush()
+
+
+    def close(self):
+        """Stops the thread and streams the rest of the files (which must be closed by their writers), then removes
+        them.
+        """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        for path in self.files:
+            self.__stream(path, complete=True)
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+        self.archive.flush()
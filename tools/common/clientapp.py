@@ -2,15 +2,21 @@
 
 import os
 import time
-import zipfile
+import json
+import pickle
+import hashlib
 import subprocess
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 from registrytool import RegistryWatcher
-from processtool import ProcessCreator, ProcessWatcher
+from processtool import ProcessCreator, ProcessWatcher, ProcessTracker, list_processes, process_memory, \
+        run_concurrently
 from windows_components import CREATE_SUSPENDED
-from folderstool import FolderWatcher
+from folderstool import FolderWatcher, FileCapture
+from archivetool import ResultArchive, LogStreamer
+from timing import Timings
 
 
 
@@ -36,19 +42,182 @@ class LogFile:
 
 
 
+def wait_for_detonation(argp, watch_folder, process_tracker):
+    """Lets the sample run. In adaptive mode the wait ends once no file events and no process creation/exit in the
+    tree of the sample (the other processes of the system are not its activity) happened for `quiet_period` seconds,
+    but not before `min_wait` and not after `wait_time` seconds.
+
+    Returns:
+        dict with the waited time and the reason the wait ended
+    """
+    t0 = time.time()
+    if not argp.adaptive:
+        subprocess.run('choice /N /T %s /D Y >nul' % (argp.wait_time,), shell=True)
+        return {'mode': 'fixed', 'waited': time.time() - t0, 'reason': 'wait_time'}
+
+    last_activity = t0
+    while 1:
+        time.sleep(0.5)
+        now = time.time()
+        last_activity = max(last_activity, watch_folder.last_activity, process_tracker.last_activity)
+
+        if now - t0 >= argp.wait_time:
+            reason = 'max_wait'
+            break
+        if now - t0 >= argp.min_wait and now - last_activity >= argp.quiet_period:
+            reason = 'quiet'
+            break
+
+    return {
+        'mode': 'adaptive',
+        'waited': now - t0,
+        'reason': reason,
+        'last_activity': max(0, last_activity - t0),
+        'min_wait': argp.min_wait,
+        'max_wait': argp.wait_time,
+        'quiet_period': argp.quiet_period
+    }
+
+
+def load_baseline(fn, sha256, registry_watcher, process_watcher):
+    """Loads registry and process snapshots captured on the same (online) VM snapshot (see capture_baseline).
+    """
+    with open(fn, 'rb') as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != sha256:
+        raise ValueError('[!] ERROR: Baseline [%s] does not match its hash [%s]' % (fn, sha256))
+    baseline = pickle.loads(data)
+    registry_watcher.compact = baseline['compact']
+    registry_watcher.d = baseline['registry']
+    process_watcher.p = set(baseline['processes'])
+    # the processes of this run's tools are not in the baseline
+    process_watcher.add_related(os.getpid())
+
+
+def capture_baseline(argp):
+    """Snapshots the registry and processes of the guest, before any sample is copied or run, and saves them in
+    `argp.baseline` for the host.
+    """
+    registry_watcher = RegistryWatcher(compact=argp.compact_registry)
+    process_watcher = ProcessWatcher()
+    t0 = time.time()
+    registry_watcher.snap()
+    process_watcher.snap()
+    with open(argp.baseline + '.tmp', 'wb') as f:
+        pickle.dump({
+            'compact': registry_watcher.compact,
+            'registry': registry_watcher.d,
+            'processes': process_watcher.p
+        }, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(argp.baseline + '.tmp', argp.baseline)
+    print('[#] Baseline captured: %d keys, %d processes, %s sec.' % (len(registry_watcher.d), len(process_watcher.p),
+            round(time.time() - t0, 3)))
+
+
+def hunt_hollows(argp, hollows_hunter_path, pids, output_dir, archive):
+    """Scans the given processes with hollows_hunter, one scan per image name (the bundled version can select the
+    processes only by name), `hunter_limit` scans at the same time. The output of every scan is moved into the
+    extraction archive (`dumps\\hollows_<image name>`) as soon as the scan ends.
+
+    Returns:
+        list of (image name, status) tuples
+    """
+    own = os.path.basename(hollows_hunter_path).lower()
+    names = sorted({name for pid, _, name in list_processes() if pid in pids and name.lower() != own})
+    scan_dirs = ['hollows_%s' % (name,) for name in names]
+
+    def store(index, status):
+        try:
+            archive.move_tree(os.path.join(output_dir, scan_dirs[index]), 'dumps\\' + scan_dirs[index])
+        except Exception as e:
+            # what is left is archived at the end
+            print('[!] ERROR: Archiving [%s]: %s' % (scan_dirs[index], e))
+
+    command_lines = ['"%s" /pname "%s" /dir "%s"' % (hollows_hunter_path, name, os.path.join(output_dir, scan_dir))
+            for name, scan_dir in zip(names, scan_dirs)]
+    scans = run_concurrently(command_lines, argp.hunter_limit, argp.hunter_timeout, working_dir=output_dir,
+            on_done=store)
+    return [(name, status) for name, (_, status) in zip(names, scans)]
+
+
+def dump_processes(argp, procdump_path, pids, output_dir, archive):
+    """Dumps the memory of the given processes with procdump, `procdump_limit` dumps at the same time. Every dump is
+    moved into the extraction archive (`dumps\\procdump_<PID>.dmp`) as soon as it is written, dumps bigger than
+    `procdump_size` MB or not finished after `procdump_timeout` seconds are discarded. Full and MiniPlus dumps hold
+    at least the private memory of the process: a process whose working set or private bytes are over `procdump_size`
+    is not dumped at all, so its dump never fills the guest disk.
+
+    Returns:
+        list of dicts with the PID, image name, status and size of every dump
+    """
+    own = os.path.basename(procdump_path).lower()
+    names = {pid: name for pid, _, name in list_processes() if pid in pids and name.lower() != own}
+    dumps = [{'pid': pid, 'name': names[pid], 'status': None, 'size': 0} for pid in sorted(names)]
+    os.makedirs(output_dir, exist_ok=True)
+    to_dump = []
+    for dump in dumps:
+        memory = process_memory(dump['pid']) if argp.procdump_type in ('ma', 'mp') else None
+        if memory and max(memory) > argp.procdump_size << 20:
+            dump.update({'status': 'too_big', 'size': max(memory)})
+        else:
+            to_dump.append(dump)
+
+    def dump_fn(dump):
+        return os.path.join(output_dir, 'procdump_%d.dmp' % (dump['pid'],))
+
+    def store(index, status):
+        dump = to_dump[index]
+        fn = dump_fn(dump)
+        try:
+            dump['size'] = os.path.getsize(fn)
+        except Exception:
+            dump['status'] = 'missing' if status == 'done' else status
+            return
+        if status != 'done':
+            dump['status'] = status
+        elif dump['size'] > argp.procdump_size << 20:
+            dump['status'] = 'too_big'
+        else:
+            archive.write(fn, 'dumps\\' + os.path.basename(fn))
+            dump['status'] = 'stored'
+        try:
+            os.remove(fn)
+        except Exception:
+            pass
+
+    command_lines = ['"%s" -accepteula -%s %d "%s"' % (procdump_path, argp.procdump_type, dump['pid'], dump_fn(dump))
+            for dump in to_dump]
+    run_concurrently(command_lines, argp.procdump_limit, argp.procdump_timeout, working_dir=output_dir,
+            on_done=store)
+    return dumps
+
+
 def execute_experiment(argp):
     MALWARE_PATH = os.path.join(argp.deploy_dir, argp.sample_name)
     ZIP_FN = os.path.join(argp.deploy_dir, argp.zip_file)
     EXTRACTION_DIR = os.path.join(argp.deploy_dir, 'dumps')
+    PROCDUMP_DIR = os.path.join(argp.deploy_dir, 'procdumps')
     CLIENT_LOG_FN = os.path.join(EXTRACTION_DIR, argp.log_file)
-    WAIT_CMD = 'choice /N /T %s /D Y >nul' % (argp.wait_time,)
+    FOLDER_CHANGES_FN = os.path.join(EXTRACTION_DIR, 'folder_changes.txt')
+    REGISTRY_CHANGES_FN = os.path.join(EXTRACTION_DIR, 'registry_changes.txt')
 
+    timings = Timings('guest')
     os.makedirs(EXTRACTION_DIR)
     logger = LogFile(CLIENT_LOG_FN)
+    archive = ResultArchive(ZIP_FN, outbox=argp.outbox)
+    # with an outbox, the logs are sent to the host as they are written
+    streamer = None
+    if argp.outbox:
+        streamer = LogStreamer(archive, {
+            CLIENT_LOG_FN: 'logs\\' + argp.log_file,
+            FOLDER_CHANGES_FN: 'logs\\folder_changes.txt',
+            REGISTRY_CHANGES_FN: 'logs\\registry_changes.txt'
+        }, argp.stream_interval)
+        streamer.start()
 
     sys.stdout = sys.stderr = logger
 
-
+    dll_lock = hollows_proc = malware_proc = registry_watcher = watch_folder = process_tracker = dumper = None
     # start monitoring apps
     try:
         dll_lock = open('%s\\tools\\pe-sieve.dll' % (argp.deploy_dir,))
@@ -60,68 +229,168 @@ def execute_experiment(argp):
         if response[0]:
             raise ValueError('[!] ERROR: Hollows hunter process creation. Code: %d' % (response[1],))
 
-        registry_watcher = RegistryWatcher(output=open(os.path.join(EXTRACTION_DIR, 'registry_changes.txt'), 'w'))
-        print('[#] Snapshotting registry...', end='')
-        t0 = time.time()
-        registry_watcher.snap()
-        print('%s sec.' % (time.time() - t0))
-
+        registry_watcher = RegistryWatcher(output=open(REGISTRY_CHANGES_FN, 'w'), compact=argp.compact_registry,
+                timings=timings)
         process_watcher = ProcessWatcher()
-        print('[#] Snapshotting processes...', end='')
-        t0 = time.time()
-        process_watcher.snap()
-        print('%s sec.' % (time.time() - t0))
-
-        watch_folder = FolderWatcher(output=open(os.path.join(EXTRACTION_DIR, 'folder_changes.txt'), 'w'))
+        if argp.baseline:
+            print('[#] Loading baseline...', end='')
+            with timings.span('baseline_load') as span:
+                load_baseline(argp.baseline, argp.baseline_hash, registry_watcher, process_watcher)
+            print('%s sec.' % (span['duration'],))
+        else:
+            print('[#] Snapshotting registry...', end='')
+            with timings.span('registry_snap') as span:
+                registry_watcher.snap()
+            print('%s sec. (%d threads)' % (span['duration'], registry_watcher.threads))
+
+            print('[#] Snapshotting processes...', end='')
+            with timings.span('process_snap') as span:
+                process_watcher.snap()
+            print('%s sec.' % (span['duration'],))
+
+        capture = None
+        if argp.capture_files:
+            capture = FileCapture(archive, argp.capture_count, argp.capture_size << 20, argp.capture_file_size << 20,
+                    timings=timings)
+        ignore = [EXTRACTION_DIR, PROCDUMP_DIR, os.path.join(argp.deploy_dir, 'tools'), ZIP_FN]
+        if argp.outbox:
+            ignore.append(argp.outbox)
+        watch_folder = FolderWatcher(output=open(FOLDER_CHANGES_FN, 'w'), ignore=ignore, capture=capture)
         watch_folder.add_to_watch()
         watch_folder.start()
 
+        if argp.registry_notify:
+            print('[#] Registering registry notifications...', end='')
+            with timings.span('registry_notify') as span:
+                registry_watcher.start_notifications()
+            print('%s sec. (%d keys)' % (span['duration'], len(registry_watcher.notifications)))
+
         print('[#] Executing [%s]...' % (MALWARE_PATH,))
         malware_proc = ProcessCreator()
-        response = malware_proc.create(MALWARE_PATH)
+        response = malware_proc.create(MALWARE_PATH, creation_flags=CREATE_SUSPENDED)
 
         if response[0]:
             hollows_proc.terminate()
             raise ValueError('[!] ERROR: Malware process creation. Code: %s' % (response[1],))
 
+        # the sample starts once it is tracked, so none of its children is missed
+        process_tracker = ProcessTracker()
+        process_tracker.track(malware_proc.pid)
+        process_tracker.start()
+        malware_proc.resume()
         print('[#] Malware process successfully created. PID: %d' % (malware_proc.pid,))
 
-        subprocess.run(WAIT_CMD, shell=True)
-        hollows_proc.resume()
-
-        process_watcher.suspend_differences()
-        watch_folder.close()
-        registry_watcher.show_diff()
+        with timings.span('detonation'):
+            detonation = wait_for_detonation(argp, watch_folder, process_tracker)
+        detonation['folder_events'] = watch_folder.events
+        if argp.registry_notify:
+            detonation['registry_events'] = registry_watcher.events
+        print('[#] Detonation ended after %.1f sec. (%s)' % (detonation['waited'], detonation['reason']))
+
+        with timings.span('process_suspend'):
+            process_tracker.close()
+            suspended = process_tracker.suspend()
+            if argp.suspend_all:
+                suspended += [pid for pid in process_watcher.suspend_differences() if pid not in suspended]
+        print('[#] Suspended processes: %s (%d tracked, %d polls)' % (suspended, len(process_tracker.records),
+                process_tracker.polls))
+        archive.writestr('logs\\processes.json', json.dumps({
+            'tracked': process_tracker.records,
+            'suspended': suspended
+        }, indent=4))
+
+        # the dumps are taken while hollows_hunter scans the same suspended processes
+        if argp.procdump:
+            dumper = ThreadPoolExecutor(1)
+            dumping = dumper.submit(timings.timed('procdump', dump_processes), argp,
+                    '%s\\tools\\procdump.exe' % (argp.deploy_dir,), suspended, PROCDUMP_DIR, archive)
+
+        if argp.hunter_full:
+            print('[#] Scanning all processes with hollows_hunter...', end='')
+            with timings.span('hollows_hunter') as span:
+                hollows_proc.resume()
+                if not hollows_proc.wait(argp.hunter_timeout):
+                    hollows_proc.terminate()
+            print('%s sec.' % (span['duration'],))
+        else:
+            hollows_proc.terminate()
+            print('[#] Scanning suspended processes with hollows_hunter...', end='')
+            with timings.span('hollows_hunter') as span:
+                scans = hunt_hollows(argp, hollows_hunter_path, suspended, EXTRACTION_DIR, archive)
+            print('%s sec. (%s)' % (span['duration'], ', '.join('%s: %s' % scan for scan in scans)))
+        if dumper:
+            print('[#] Dumping suspended processes with procdump...', end='')
+            with timings.span('procdump_wait') as span:
+                dumps = dumping.result()
+                dumper.shutdown()
+            print('%s sec. more (%s)' % (span['duration'], ', '.join('%(pid)d: %(status)s' % dump
+                    for dump in dumps)))
+            archive.writestr('logs\\procdumps.json', json.dumps(dumps, indent=4))
+        with timings.span('folder_close'):
+            watch_folder.close()
+        if not streamer:
+            archive.move(FOLDER_CHANGES_FN, 'logs\\folder_changes.txt')
+        detonation['folder_metrics'] = watch_folder.metrics()
+        print('[#] Folder events: %(events)d, written: %(written)d, overflows: %(overflows)d, dropped: %(dropped)d, '
+                'max queued: %(max_queued)d, max latency: %(max_latency).3f sec.' % detonation['folder_metrics'])
+        archive.writestr('logs\\detonation.json', json.dumps(detonation, indent=4))
+        if capture:
+            print('[#] Captured files: %(captured)d, duplicates: %(duplicates)d, too big: %(too_big)d, over budget: '
+                    '%(over_budget)d, errors: %(errors)d' % capture.stats)
+            archive.writestr('logs\\captured_files.json', json.dumps(capture.index, indent=4))
+        if argp.registry_notify:
+            registry_watcher.stop_notifications()
+            print('[#] Registry changes logged as they happened: %d' % (registry_watcher.events,))
+        if not argp.registry_notify or argp.registry_check:
+            if argp.registry_notify:
+                print('# changes missed by the notifications:', file=registry_watcher.output)
+            print('[#] Diffing registry...', end='')
+            with timings.span('registry_diff') as span:
+                registry_watcher.show_diff()
+            print('%s sec. (%d threads, %d keys, %d unchanged)' % (span['duration'], registry_watcher.threads,
+                    registry_watcher.stats['keys'], registry_watcher.stats['unchanged']))
+        else:
+            registry_watcher.output.close()
+        if not streamer:
+            archive.move(REGISTRY_CHANGES_FN, 'logs\\registry_changes.txt')
 
         malware_proc.terminate()
     except ValueError as e:
         print(str(e))
+    finally:
+        # after an error, what is still running is stopped (a second stop does nothing), and the results so far are
+        # archived: the host gets the final chunk and the manifest even if the run failed
         if hollows_proc:
             hollows_proc.terminate()
         if malware_proc:
             malware_proc.terminate()
-        if watch_folder:
+        if process_tracker:
+            process_tracker.close()
+        if dumper:
+            dumper.shutdown()
+        if watch_folder and not watch_folder.stop:
             watch_folder.close()
-    except Exception:
-        if hollows_proc:
-            hollows_proc.terminate()
-        if malware_proc:
-            malware_proc.terminate()
-        if watch_folder:
-            watch_folder.close()
-        raise
-
-
-    logger.close()
-    dll_lock.close()
-
-    with zipfile.ZipFile(ZIP_FN, 'a') as zip_file:
-        for root, _, files in os.walk(EXTRACTION_DIR):
-            for f in files:
-                if f.endswith('log') or f.endswith('txt'):
-                    zip_file.write(os.path.join(root, f), 'logs\\' + f)
-                else:
-                    zip_file.write(os.path.join(root, f), 'dumps\\' + f)
+        if registry_watcher:
+            registry_watcher.stop_notifications()
+
+        logger.close()
+        if dll_lock:
+            dll_lock.close()
+        if streamer:
+            streamer.close()
+
+        # what was not archived as the run went (the log, the output of a full hollows_hunter scan, the outputs left
+        # by an error)
+        with timings.span('archive'):
+            for root, _, files in os.walk(EXTRACTION_DIR):
+                for f in files:
+                    path = os.path.join(root, f)
+                    if root == EXTRACTION_DIR and (f.endswith('log') or f.endswith('txt')):
+                        archive.write(path, 'logs\\' + f)
+                    else:
+                        archive.write(path, 'dumps\\' + os.path.relpath(path, EXTRACTION_DIR))
+        archive.writestr('logs\\timings.json', json.dumps(timings.to_json(), indent=4))
+        archive.close()
 
 
 if __name__ == '__main__':
@@ -130,9 +399,36 @@ if __name__ == '__main__':
     args.add_argument('-dd', '--deploy_dir', default=os.path.join('C:\\', 'maltest'))
     args.add_argument('-sn', '--sample_name', default='a.exe')
     args.add_argument('-wt', '--wait_time', default='30', type=int)
+    args.add_argument('-aw', '--adaptive', action='store_true')
+    args.add_argument('-mw', '--min_wait', default='5', type=int)
+    args.add_argument('-qp', '--quiet_period', default='10', type=int)
+    args.add_argument('-cr', '--compact_registry', action='store_true')
+    args.add_argument('-bl', '--baseline')
+    args.add_argument('-bh', '--baseline_hash')
+    args.add_argument('-cb', '--capture_baseline', action='store_true')
+    args.add_argument('-rn', '--registry_notify', action='store_true')
+    args.add_argument('-rc', '--registry_check', action='store_true')
+    args.add_argument('-sa', '--suspend_all', action='store_true')
+    args.add_argument('-hf', '--hunter_full', action='store_true')
+    args.add_argument('-hl', '--hunter_limit', default='4', type=int)
+    args.add_argument('-ht', '--hunter_timeout', default='120', type=int)
+    args.add_argument('-pd', '--procdump', action='store_true')
+    args.add_argument('-pt', '--procdump_type', default='ma', choices=('ma', 'mp', 'mm'))
+    args.add_argument('-pl', '--procdump_limit', default='4', type=int)
+    args.add_argument('-po', '--procdump_timeout', default='60', type=int)
+    args.add_argument('-ps', '--procdump_size', default='512', type=int)
+    args.add_argument('-cf', '--capture_files', action='store_true')
+    args.add_argument('-cn', '--capture_count', default='100', type=int)
+    args.add_argument('-cs', '--capture_size', default='64', type=int)
+    args.add_argument('-cm', '--capture_file_size', default='8', type=int)
     args.add_argument('-lf', '--log_file', default='clientapp.log')
     args.add_argument('-zf', '--zip_file', default='extraction.zip')
+    args.add_argument('-ob', '--outbox')
+    args.add_argument('-si', '--stream_interval', default='5', type=int)
 
     argp = args.parse_args()
 
-    execute_experiment(argp)
+    if argp.capture_baseline:
+        capture_baseline(argp)
+    else:
+        execute_experiment(argp)
@@ -2,14 +2,19 @@
 
 import sys
 import os
+import time
+import queue
+import struct
+import hashlib
 import threading
 
-from windows_components import CreateFile, CloseHandle, ReadDirectoryChangesW, sizeof, create_string_buffer, byref, \
-        GetLastError, memset, cast
-from windows_components import GENERIC_READ, FILE_SHARE_READ, FILE_SHARE_WRITE, OPEN_EXISTING, DWORD, MAX_PATH, \
-        FILE_FLAG_BACKUP_SEMANTICS, INVALID_HANDLE_VALUE, FILE_NOTIFY_INFORMATION, FILE_NOTIFY_CHANGE_ATTRIBUTES, \
-        FILE_NOTIFY_CHANGE_CREATION, FILE_NOTIFY_CHANGE_DIR_NAME, FILE_NOTIFY_CHANGE_FILE_NAME, \
-        FILE_NOTIFY_CHANGE_LAST_WRITE, FILE_NOTIFY_CHANGE_SECURITY, FILE_NOTIFY_CHANGE_SIZE, PFILE_NOTIFY_INFORMATION
+from windows_components import CreateFile, CloseHandle, ReadDirectoryChangesW, create_string_buffer, byref, \
+        GetLastError, CreateIoCompletionPort, GetQueuedCompletionStatus, CancelIoEx
+from windows_components import GENERIC_READ, FILE_SHARE_READ, FILE_SHARE_WRITE, OPEN_EXISTING, DWORD, HANDLE, \
+        ULONG_PTR, FILE_FLAG_BACKUP_SEMANTICS, FILE_FLAG_OVERLAPPED, INVALID_HANDLE_VALUE, OVERLAPPED, LPOVERLAPPED, \
+        FILE_NOTIFY_CHANGE_ATTRIBUTES, FILE_NOTIFY_CHANGE_CREATION, FILE_NOTIFY_CHANGE_DIR_NAME, \
+        FILE_NOTIFY_CHANGE_FILE_NAME, FILE_NOTIFY_CHANGE_LAST_WRITE, FILE_NOTIFY_CHANGE_SECURITY, \
+        FILE_NOTIFY_CHANGE_SIZE, ERROR_NOTIFY_ENUM_DIR, ERROR_OPERATION_ABORTED
 
 
 EVENTS = {
@@ -19,69 +24,327 @@ EVENTS = {
     0x00000004: 'change/old_name',
     0x00000005: 'change/new_name'
 }
+NOTIFY_FILTERS = FILE_NOTIFY_CHANGE_FILE_NAME | FILE_NOTIFY_CHANGE_DIR_NAME | FILE_NOTIFY_CHANGE_ATTRIBUTES | \
+        FILE_NOTIFY_CHANGE_SIZE | FILE_NOTIFY_CHANGE_LAST_WRITE | FILE_NOTIFY_CHANGE_CREATION | \
+        FILE_NOTIFY_CHANGE_SECURITY
+# size of every notification buffer (ReadDirectoryChangesW fails on network shares above 64KB)
+BUFFER_SIZE = 64 * 1024
+# milliseconds to wait for a completion before checking if the watcher was stopped
+COMPLETION_TIMEOUT = 500
+# events waiting to be written, further events are dropped
+QUEUE_SIZE = 100000
+# events taken from the queue at once and coalesced
+WRITE_BATCH = 1000
+# seconds without events after which a file is captured
+CAPTURE_DELAY = 1
+# actions of the markers queued with the events
+OVERFLOW = -1
+DROPPED = -2
+
+
+
+def parse_notifications(data):
+    """Parses the FILE_NOTIFY_INFORMATION records returned by ReadDirectoryChangesW.
+
+    Returns:
+        generator of (action, relative path) tuples
+    """
+    offs = 0
+    while offs + 12 <= len(data):
+        nextoffs, action, namelen = struct.unpack_from('<III', data, offs)
+        yield action, data[offs + 12:offs + 12 + namelen].decode('utf-16-le')
+        if not nextoffs:
+            break
+        offs += nextoffs
+
+
+
+class DirectoryWatch():
+    """Overlapped ReadDirectoryChangesW on a directory tree. Two buffers are used: the next read is issued in one
+    while the notifications of the other are handled.
+    """
+
+
+    def __init__(self, path, handle):
+        self.path = path
+        self.handle = handle
+        self.buffers = [create_string_buffer(BUFFER_SIZE) for _ in range(2)]
+        self.overlapped = [OVERLAPPED() for _ in range(2)]
+        self.current = 0
+
+
+    def read(self):
+        """Issues the next read.
+
+        Returns:
+            int: index of the buffer being filled
+        """
+        if not ReadDirectoryChangesW(HANDLE(self.handle), self.buffers[self.current], BUFFER_SIZE, True,
+                NOTIFY_FILTERS, None, byref(self.overlapped[self.current]), None):
+            print('ERROR: ReadDirectoryChanges() failed on [%s]. Code: %x!' % (self.path, GetLastError()))
+            return None
+        return self.current
+
+
+    def completed(self, returned):
+        """Issues the next read in the other buffer and returns the data of the completed one.
+        """
+        data = self.buffers[self.current].raw[:returned]
+        self.current ^= 1
+        self.read()
+        return data
+
+
+
+class FileCapture():
+    """Copies the created/modified files into the extraction archive (`files\\<SHA-256>`), within a budget of
+    files and bytes. A file is captured once no event happened on it for CAPTURE_DELAY seconds, files with the same
+    content are stored once.
+    """
+
+
+    def __init__(self, archive, max_files=100, max_bytes=64 << 20, max_file_size=8 << 20, timings=None):
+        self.archive = archive
+        # `Timings` in which every capture is recorded
+        self.timings = timings
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.pending = {}
+        self.hashes = set()
+        self.index = []
+        self.captured_bytes = 0
+        self.stats = {'captured': 0, 'duplicates': 0, 'too_big': 0, 'over_budget': 0, 'errors': 0}
+
+
+    def touch(self, fn, timestamp):
+        self.pending[fn] = timestamp
+
+
+    def flush(self, force=False):
+        now = time.time()
+        for fn, timestamp in list(self.pending.items()):
+            if force or now - timestamp >= CAPTURE_DELAY:
+                del self.pending[fn]
+                if self.timings:
+                    with self.timings.span('file_capture', path=fn):
+                        self.capture(fn, timestamp)
+                else:
+                    self.capture(fn, timestamp)
+
+
+    def capture(self, fn, timestamp):
+        if self.stats['captured'] >= self.max_files:
+            self.stats['over_budget'] += 1
+            return
+        try:
+            size = os.path.getsize(fn)
+            if size > self.max_file_size:
+                self.stats['too_big'] += 1
+                return
+            if self.captured_bytes + size > self.max_bytes:
+                self.stats['over_budget'] += 1
+                return
+            with open(fn, 'rb') as f:
+                data = f.read(self.max_file_size + 1)
+        except Exception:
+            # deleted or locked by its writer
+            self.stats['errors'] += 1
+            return
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        self.index.append({'path': fn, 'sha256': sha256, 'size': len(data), 'time': timestamp})
+        if sha256 in self.hashes:
+            self.stats['duplicates'] += 1
+            return
+        self.hashes.add(sha256)
+        self.archive.writestr('files\\' + sha256, data)
+        self.captured_bytes += len(data)
+        self.stats['captured'] += 1
+
+
+
+class FolderEventWriter(threading.Thread):
+    """Writes the events queued by FolderWatcher, so the watcher does not stat files between its reads. Events are
+    taken in batches and coalesced: only the first event of every file is written, with the file size.
+    """
+
+
+    def __init__(self, events, output, ignore=(), capture=None):
+        super().__init__(daemon=True)
+        self.events = events
+        self.output = output
+        self.ignore = ignore
+        self.capture = capture
+        self.seen = set()
+        self.written = 0
+        # seconds between a notification and the writing of its event
+        self.max_latency = 0
+
+
+    def write(self, timestamp, action, fn):
+        if action == OVERFLOW:
+            print('[%s] overflow: events lost, rescan needed' % (fn,), file=self.output)
+        elif action == DROPPED:
+            print('[%s] dropped: events lost, rescan needed' % (fn,), file=self.output)
+        elif fn not in self.seen and not os.path.isdir(fn):
+            try:
+                size = '%s bytes' % os.path.getsize(fn)
+            except Exception:
+                size = 'missing'
+            print('[%s] changed: %s (%s)' % (fn, EVENTS[action], size), file=self.output)
+            self.seen.add(fn)
+            self.written += 1
+        if self.capture and action in (1, 3, 5) and not fn.lower().startswith(self.ignore) and fn in self.seen:
+            self.capture.touch(fn, timestamp)
+        self.max_latency = max(self.max_latency, time.time() - timestamp)
+
+
+    def run(self):
+        while 1:
+            try:
+                batch = [self.events.get(timeout=CAPTURE_DELAY)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self.events.get_nowait())
+                except queue.Empty:
+                    break
+
+            coalesced = set()
+            for event in batch:
+                if event is None:
+                    if self.capture:
+                        self.capture.flush(force=True)
+                    return
+                if event[2] in coalesced and event[1] > 0:
+                    continue
+                coalesced.add(event[2])
+                self.write(*event)
+            if self.capture:
+                self.capture.flush()
+
 
 
 class FolderWatcher(threading.Thread):
 
 
-    def __init__(self, output=sys.stdout):
+    def __init__(self, output=sys.stdout, ignore=(), capture=None):
         super().__init__()
-        self.hfolders = {}
+        self.watches = []
+        self.port = CreateIoCompletionPort(HANDLE(INVALID_HANDLE_VALUE), None, 0, 0)
         self.stop = 0
-        self.results = []
         self.output = output
+        self.queue = queue.Queue(QUEUE_SIZE)
+        # events under these paths (e.g. our own output) are not counted as activity nor captured
+        self.ignore = tuple(p.lower() for p in ignore)
+        self.capture = capture
+        self.writer = FolderEventWriter(self.queue, output, self.ignore, capture)
+        self.events = 0
+        self.overflows = 0
+        self.dropped = 0
+        self.max_queued = 0
+        self.last_activity = time.time()
 
 
     def add_to_watch(self, path='C:\\'):
         handle = CreateFile(path, GENERIC_READ, FILE_SHARE_READ | FILE_SHARE_WRITE, None, OPEN_EXISTING,
-                FILE_FLAG_BACKUP_SEMANTICS, None)
+                FILE_FLAG_BACKUP_SEMANTICS | FILE_FLAG_OVERLAPPED, None)
         if handle == INVALID_HANDLE_VALUE:
             print('[!] ERROR: Could not get handle for [%s] directory!' % (path,), file=sys.stderr)
             sys.exit(-1)
 
-        self.hfolders[path] = handle
+        # the completion key is the index of the watch
+        CreateIoCompletionPort(HANDLE(handle), HANDLE(self.port), len(self.watches), 0)
+        self.watches.append(DirectoryWatch(path, handle))
 
 
     def close(self):
         self.stop = 1
-        for h in self.hfolders.values():
-            CloseHandle(h)
+        if self.is_alive():
+            self.join(COMPLETION_TIMEOUT * 4 / 1000)
+        for watch in self.watches:
+            CancelIoEx(HANDLE(watch.handle), None)
+            CloseHandle(HANDLE(watch.handle))
+        CloseHandle(HANDLE(self.port))
+
+        if self.writer.is_alive():
+            if self.dropped:
+                self.queue.put((time.time(), DROPPED, '%d events' % (self.dropped,)))
+            self.queue.put(None)
+            self.writer.join()
         if self.output is not sys.stdout:
             self.output.close()
 
 
+    def metrics(self):
+        return {
+            'events': self.events,
+            'written': self.writer.written,
+            'overflows': self.overflows,
+            'dropped': self.dropped,
+            'max_queued': self.max_queued,
+            'max_latency': self.writer.max_latency,
+            'capture': self.capture.stats if self.capture else None
+        }
+
+
+    def __queue(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.max_queued = max(self.max_queued, self.queue.qsize())
+
+
+    def handle_event(self, root, action, name):
+        if action not in EVENTS:
+            return
+        fn = os.path.join(root, name)
+        now = time.time()
+        if not fn.lower().startswith(self.ignore):
+            self.events += 1
+            self.last_activity = now
+        self.__queue((now, action, fn))
+
+
+    def handle_overflow(self, root):
+        """The notifications did not fit in the buffer and were lost, the tree has to be rescanned to find the
+        changed files.
+        """
+        self.overflows += 1
+        self.last_activity = time.time()
+        self.__queue((self.last_activity, OVERFLOW, root))
+
+
     def run(self):
-        notify_filters = FILE_NOTIFY_CHANGE_FILE_NAME | FILE_NOTIFY_CHANGE_DIR_NAME | FILE_NOTIFY_CHANGE_ATTRIBUTES | \
-                FILE_NOTIFY_CHANGE_SIZE | FILE_NOTIFY_CHANGE_LAST_WRITE | FILE_NOTIFY_CHANGE_CREATION | \
-                FILE_NOTIFY_CHANGE_SECURITY
+        self.writer.start()
+        for watch in self.watches:
+            watch.read()
 
-        bufsize = (sizeof(FILE_NOTIFY_INFORMATION) + MAX_PATH * 2) * 100
-        buffer = create_string_buffer(bufsize)
         returned = DWORD(0)
-        while 1:
-            if self.stop:
-                break
-            for p, h in self.hfolders.items():
-                memset(buffer, 0, bufsize)
-                if not ReadDirectoryChangesW(h, buffer, bufsize, True, notify_filters, byref(returned), None, None):
-                    print('ERROR: ReadDirectoryChanges() failed. Code: %x!' % GetLastError())
-
-                offs = 0
-                for _ in range(100):
-                    fni = cast(buffer[offs:offs + sizeof(FILE_NOTIFY_INFORMATION)], PFILE_NOTIFY_INFORMATION).contents
-                    namelen, nextoffs = int(fni.FileNameLength), int(fni.NextEntryOffset)
-                    name = buffer.raw[offs + 12:offs + 12 + namelen].decode('utf16')
-                    evt = EVENTS.get(fni.Action)
-                    if evt is None:
-                        continue
-                    fn = os.path.join(p, name)
-                    if (not os.path.isdir(fn)) and fn not in self.results:
-                        try:
-                            size = '%s bytes' % os.path.getsize(fn)
-                        except Exception:
-                            size = 'missing'
-                        print('[%s] changed: %s (%s)' % (fn, evt, size), file=self.output)
-                        self.results.append(fn)
-                    if not nextoffs:
-                        break
-                    offs += nextoffs
+        key = ULONG_PTR(0)
+        overlapped = LPOVERLAPPED()
+        while not self.stop:
+            ok = GetQueuedCompletionStatus(HANDLE(self.port), byref(returned), byref(key), byref(overlapped),
+                    COMPLETION_TIMEOUT)
+            if not overlapped:
+                # timeout
+                continue
+            watch = self.watches[key.value]
+            error = 0 if ok else GetLastError()
+            if error == ERROR_OPERATION_ABORTED:
+                continue
+            if error and error != ERROR_NOTIFY_ENUM_DIR:
+                print('ERROR: ReadDirectoryChanges() failed on [%s]. Code: %x!' % (watch.path, error))
+                watch.completed(0)
+                continue
+
+            data = watch.completed(returned.value if not error else 0)
+            if not data:
+                self.handle_overflow(watch.path)
+                continue
+            for action, name in parse_notifications(data):
+                self.handle_event(watch.path, action, name)
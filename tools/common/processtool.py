@@ -1,8 +1,115 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from windows_components import CreateProcess, GetLastError, byref, SuspendThread, ResumeThread, TerminateProcess, \
         CreateToolhelp32Snapshot, CloseHandle, Process32First, Process32Next, Thread32First, Thread32Next, OpenThread, \
-        sizeof
-from windows_components import PROCESS_INFORMATION, STARTUPINFO, DWORD, INVALID_HANDLE_VALUE, PROCESSENTRY32, \
-        TH32CS_SNAPPROCESS, TH32CS_SNAPTHREAD, THREADENTRY32, THREAD_SUSPEND_RESUME
+        OpenProcess, NtSuspendProcess, WaitForSingleObject, GetProcessMemoryInfo, create_unicode_buffer, sizeof
+from windows_components import PROCESS_INFORMATION, STARTUPINFO, DWORD, HANDLE, INVALID_HANDLE_VALUE, PROCESSENTRY32, \
+        TH32CS_SNAPPROCESS, TH32CS_SNAPTHREAD, THREADENTRY32, THREAD_SUSPEND_RESUME, PROCESS_SUSPEND_RESUME, \
+        INFINITE, WAIT_OBJECT_0, PROCESS_MEMORY_COUNTERS_EX, PROCESS_QUERY_LIMITED_INFORMATION, PROCESS_VM_READ
+
+
+# seconds between two polls of the process list by ProcessTracker
+TRACK_INTERVAL = 0.05
+
+
+
+def list_processes():
+    """Get the processes currently running on the system.
+
+    Returns:
+        list of (PID, parent PID, image name) tuples
+    """
+    processes = []
+    hProcessSnap = CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0x0)
+    if hProcessSnap == INVALID_HANDLE_VALUE:
+        print('   [!] ERROR-list: CreateToolhelp32Snapshot. Code: %d' % (GetLastError(),))
+        return processes
+
+    pe32 = PROCESSENTRY32()
+    pe32.dwSize = sizeof(pe32)
+    if not Process32First(hProcessSnap, byref(pe32)):
+        print('   [!] ERROR-list: Process32First. Code: %d' % (GetLastError(),))
+        CloseHandle(hProcessSnap)
+        return processes
+
+    while 1:
+        processes.append((pe32.th32ProcessID, pe32.th32ParentProcessID, pe32.szExeFile.decode(errors='replace')))
+
+        code = Process32Next(hProcessSnap, byref(pe32))
+        if not code:
+            break
+
+    CloseHandle(hProcessSnap)
+    return processes
+
+
+def suspend_process(pid):
+    """Suspend all the threads of a process (NtSuspendProcess).
+
+    Returns:
+        bool: True on success
+    """
+    hProcess = OpenProcess(PROCESS_SUSPEND_RESUME, False, pid)
+    if not hProcess:
+        print('   [!] ERROR-suspend: OpenProcess(%d). Code: %d' % (pid, GetLastError()))
+        return False
+    status = NtSuspendProcess(HANDLE(hProcess))
+    CloseHandle(HANDLE(hProcess))
+    return status == 0
+
+
+def process_memory(pid):
+    """Get the memory used by a process (GetProcessMemoryInfo).
+
+    Returns:
+        tuple of (working set, private bytes) or None if the process can't be queried
+    """
+    hProcess = OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION | PROCESS_VM_READ, False, pid)
+    if not hProcess:
+        print('   [!] ERROR-memory: OpenProcess(%d). Code: %d' % (pid, GetLastError()))
+        return None
+    counters = PROCESS_MEMORY_COUNTERS_EX()
+    counters.cb = sizeof(counters)
+    ok = GetProcessMemoryInfo(HANDLE(hProcess), byref(counters), sizeof(counters))
+    CloseHandle(HANDLE(hProcess))
+    if not ok:
+        return None
+    return counters.WorkingSetSize, counters.PrivateUsage
+
+
+def run_concurrently(command_lines, limit, timeout, working_dir=None, on_done=None):
+    """Runs the command lines, at most `limit` at the same time. Processes still running after `timeout` seconds are
+    terminated.
+
+    Args:
+        on_done: called with the index of the command line and its status as soon as the process ends (from a
+            worker thread), so its output can be handled while the others run
+
+    Returns:
+        list of (command line, status) tuples, status being 'done', 'timeout' or 'error'
+    """
+    def execute(command_line):
+        proc = ProcessCreator()
+        # CreateProcessW may modify the command line
+        if proc.create(command_line=create_unicode_buffer(command_line), working_dir=working_dir)[0]:
+            return 'error'
+        if proc.wait(timeout):
+            return 'done'
+        proc.terminate()
+        # the output of a terminated process may still be open
+        proc.wait(1)
+        return 'timeout'
+
+    def run(index):
+        status = execute(command_lines[index])
+        if on_done:
+            on_done(index, status)
+        return command_lines[index], status
+
+    with ThreadPoolExecutor(max(1, limit)) as pool:
+        return list(pool.map(run, range(len(command_lines))))
 
 
 
@@ -79,6 +186,20 @@ class ProcessCreator():
         return (0, ret_code)
 
 
+    def wait(self, timeout=None):
+        """Wait for the process to exit.
+        More: https://docs.microsoft.com/en-us/windows/desktop/api/synchapi/nf-synchapi-waitforsingleobject
+
+        Args:
+            timeout: seconds to wait, None to wait until the process exits
+
+        Returns:
+            bool: True if the process exited
+        """
+        ret_code = WaitForSingleObject(HANDLE(self.hprocess), INFINITE if timeout is None else int(timeout * 1000))
+        return ret_code == WAIT_OBJECT_0
+
+
     def terminate(self):
         """Terminate process.
         More:
@@ -101,7 +222,7 @@ class ProcessWatcher():
 
 
     def __init__(self):
-        self.p = []
+        self.p = set()
 
 
     def snap(self):
@@ -120,8 +241,7 @@ class ProcessWatcher():
             return
 
         while 1:
-            if pe32.th32ProcessID not in self.p:
-                self.p.append(pe32.th32ProcessID)
+            self.p.add(pe32.th32ProcessID)
 
             code = Process32Next(hProcessSnap, byref(pe32))
             if not code:
@@ -130,20 +250,50 @@ class ProcessWatcher():
         CloseHandle(hProcessSnap)
 
 
+    def parents(self):
+        """Get the parent of every process currently running on the system.
+
+        Returns:
+            dict of PID -> parent PID
+        """
+        return {pid: ppid for pid, ppid, _ in list_processes()}
+
+
+    def add_related(self, pid):
+        """Add to the snapshot the ancestors of a process and the processes they started. Used when the snapshot
+        comes from a baseline taken in another run, which does not know the PIDs of the current tools.
+
+        Args:
+            pid: int, process ID of the tool (i.e. clientapp)
+        """
+        parents = self.parents()
+        ancestors = set()
+        while pid in parents and pid not in ancestors:
+            ancestors.add(pid)
+            pid = parents[pid]
+
+        for p, ppid in parents.items():
+            if p in ancestors or ppid in ancestors:
+                self.p.add(p)
+
+
     def suspend_differences(self):
         """Get a fresh snapshot of processes and suspend it if PID is unknown.
+
+        Returns:
+            list of suspended PIDs
         """
         hProcessSnap = CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0x0)
         if hProcessSnap == INVALID_HANDLE_VALUE:
             print('   [!] ERROR-suspend: CreateToolhelp32Snapshot. Code: %d' % (GetLastError(),))
-            return
+            return []
 
         pe32 = PROCESSENTRY32()
         pe32.dwSize = sizeof(pe32)
         if not Process32First(hProcessSnap, byref(pe32)):
             print('   [!] ERROR-suspend: Process32First. Code: %d' % (GetLastError(),))
             CloseHandle(hProcessSnap)
-            return
+            return []
 
         to_suspend = []
         while 1:
@@ -157,6 +307,7 @@ class ProcessWatcher():
         CloseHandle(hProcessSnap)
 
         self.suspend_process(to_suspend)
+        return to_suspend
 
 
     def suspend_process(self, pid):
@@ -187,3 +338,105 @@ class ProcessWatcher():
                 break
 
         CloseHandle(hThreadSnapshot)
+
+
+
+class ProcessTracker(threading.Thread):
+    """Follows the process tree of the sample: the process list is polled every `interval` seconds, so children
+    which exit before the end of the experiment are seen too.
+    """
+
+
+    def __init__(self, interval=TRACK_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stop = 0
+        self.lock = threading.Lock()
+        # PID -> record of the tracked processes which are running
+        self.alive = {}
+        self.records = []
+        self.polls = 0
+        self.last_activity = time.time()
+
+
+    def __add(self, pid, ppid, name):
+        record = {'pid': pid, 'ppid': ppid, 'name': name, 'started': time.time(), 'exited': None}
+        self.alive[pid] = record
+        self.records.append(record)
+        self.last_activity = record['started']
+
+
+    def track(self, pid, name=None):
+        """Tracks a process (i.e. the sample) and its descendants.
+        """
+        with self.lock:
+            self.__add(pid, None, name)
+
+
+    def poll(self):
+        processes = {pid: (ppid, name) for pid, ppid, name in list_processes()}
+        now = time.time()
+        with self.lock:
+            self.polls += 1
+            # a reused PID has another image name
+            exited = [pid for pid, record in self.alive.items()
+                    if pid not in processes or record['name'] not in (None, processes[pid][1])]
+
+            # children are matched before the exits are marked: a parent which exited since the last poll still
+            # adopts the children it created meanwhile (unless its PID was reused)
+            parents = set(self.alive).difference(pid for pid in exited if pid in processes)
+            # a child may come before its parent in the list
+            added = True
+            while added:
+                added = False
+                for pid, (ppid, name) in processes.items():
+                    if pid not in self.alive and ppid in parents and ppid != pid:
+                        self.__add(pid, ppid, name)
+                        parents.add(pid)
+                        added = True
+
+            for pid in exited:
+                self.alive[pid]['exited'] = now
+                del self.alive[pid]
+                self.last_activity = now
+            for pid, record in self.alive.items():
+                if record['name'] is None:
+                    record['name'] = processes[pid][1]
+
+
+    def descendants(self):
+        """Returns:
+            list of the PIDs of the running descendants of the tracked processes
+        """
+        with self.lock:
+            return [pid for pid, record in self.alive.items() if record['ppid'] is not None]
+
+
+    def run(self):
+        while not self.stop:
+            self.poll()
+            time.sleep(self.interval)
+
+
+    def close(self):
+        self.stop = 1
+        if self.is_alive():
+            self.join()
+
+
+    def suspend(self, rounds=3):
+        """Suspends the running tracked processes (the sample included) and their descendants, polling again for
+        children created meanwhile.
+
+        Returns:
+            list of suspended PIDs
+        """
+        suspended = []
+        for _ in range(rounds):
+            self.poll()
+            with self.lock:
+                pids = [pid for pid in self.alive if pid not in suspended]
+            if not pids:
+                break
+            suspended += [pid for pid in pids if suspend_process(pid)]
+        return suspended
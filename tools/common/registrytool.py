@@ -2,137 +2,596 @@
 
 import os
 import sys
-import fnmatch
+import time
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 import winreg   # NOQA
 
+from whitelist import Whitelist
+from windows_components import CreateEvent, SetEvent, CloseHandle, WaitForMultipleObjects, RegNotifyChangeKeyValue, \
+        GetLastError
+from windows_components import HANDLE, INFINITE, WAIT_OBJECT_0, WAIT_FAILED, MAXIMUM_WAIT_OBJECTS, ERROR_SUCCESS, \
+        REG_NOTIFY_CHANGE_NAME, REG_NOTIFY_CHANGE_LAST_SET
+
 
-WHITELIST = []
 REG_WATCHER = None
+# in compact mode, larger values are kept only as a digest
+COMPACT_VALUE_SIZE = 128
+# subtrees of the hives and of these keys are walked in parallel
+SPLIT_KEYS = ('HKLM/SOFTWARE', 'HKLM/SYSTEM', 'HKCU/SOFTWARE')
+REG_THREADS = 8
 REG_WHITELIST = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'registry.whitelist')
 RK_MAP = {
     winreg.HKEY_CURRENT_USER: 'HKCU',
     winreg.HKEY_LOCAL_MACHINE: 'HKLM',
 }
+NOTIFY_FILTERS = REG_NOTIFY_CHANGE_NAME | REG_NOTIFY_CHANGE_LAST_SET
+# seconds between the first signal of a notification and the reading of its key, the changes made meanwhile (e.g. a
+# burst of writes) are read at once
+RESCAN_DELAY = 0.2
 
 
 # load registry whitelist
-if os.path.exists(REG_WHITELIST):
-    with open(REG_WHITELIST) as fr:
-        for path in fr.readlines():
-            WHITELIST.append(path.lower().replace('\\', '/'))
+WHITELIST = Whitelist.load(REG_WHITELIST) if os.path.exists(REG_WHITELIST) else Whitelist()
 
 
 def whitelisted(path):
-    pth = path.lower().replace('\\', '/')
-    for e in WHITELIST:
-        if fnmatch.fnmatch(pth, e):
-            return True
+    return WHITELIST.matches(path)
+
+
+def _value_size(val):
+    if isinstance(val, (str, bytes)):
+        return len(val)
+    if isinstance(val, list):
+        return sum(len(v) for v in val)
+    return 0
+
+
+def compact_value(val):
+    """Value as stored in a compact snapshot: small values as they are, larger ones as a ('digest', description)
+    tuple, which is reported as the old value if they change (registry values are never tuples).
+    """
+    size = _value_size(val)
+    if size <= COMPACT_VALUE_SIZE:
+        return val
+    return ('digest', '<%d %s, blake2b %s>' % (size, 'bytes' if isinstance(val, bytes) else 'chars',
+            hashlib.blake2b(val if isinstance(val, bytes) else repr(val).encode(), digest_size=8).hexdigest()))
+
+
+def shown_value(val):
+    return val[1] if isinstance(val, tuple) else val
+
+
+def _resolve(d):
+    # replaces the futures of a snapshot made by `RegistryWatcher.__snap_split` with their subtrees
+    for name in list(d):
+        if name in (0, 1):
+            continue
+        if isinstance(d[name], Future):
+            d[name] = d[name].result()
+            if d[name] is None:
+                del d[name]
+        else:
+            _resolve(d[name])
+
+
+
+def format_change(path, old, new):
+    if old is None:
+        op = 'created: [%s]' % new
+    elif new is None:
+        op = 'deleted (was [%s])' % old
+    else:
+        op = 'changed: [%s] -> [%s]' % (old, new)
+    return '[%s]: %s' % (path, op)
+
+
+def compare(path, old, new, changes):
+    """Appends to `changes` the differences between two snapshots of the same key (None if the key is missing).
+    """
+    old = old or {0: {}}
+    new = new or {0: {}}
+    for name, val in new[0].items():
+        if name not in old[0]:
+            changes.append(('%s/%s' % (path, name), None, shown_value(val)))
+        elif old[0][name] != val:
+            changes.append(('%s/%s' % (path, name), shown_value(old[0][name]), shown_value(val)))
+    for name, val in old[0].items():
+        if name not in new[0]:
+            changes.append(('%s/%s' % (path, name), shown_value(val), None))
+    for name in new:
+        if name not in (0, 1):
+            compare('%s/%s' % (path, name), old.get(name), new[name], changes)
+    for name in old:
+        if name not in (0, 1) and name not in new:
+            compare('%s/%s' % (path, name), old[name], None, changes)
+
+
+
+class RegistryNotification():
+    """Change notification of a key: of its whole subtree or, for hives and SPLIT_KEYS, only of its values and
+    subkeys list. `parent[name]` is the snapshot of the key.
+    """
+
+
+    def __init__(self, path, key, parent, name, subtree):
+        self.path = path
+        self.key = key
+        self.parent = parent
+        self.name = name
+        self.subtree = subtree
+        self.event = CreateEvent(None, False, False, None)
+        self.closed = False
+
+
+    def arm(self):
+        """Registers the notification, which is signaled once, on the next change.
+
+        Returns:
+            bool: False if the key was deleted or closed
+        """
+        if self.closed:
+            return False
+        return RegNotifyChangeKeyValue(HANDLE(int(self.key)), self.subtree, NOTIFY_FILTERS, HANDLE(self.event),
+                True) == ERROR_SUCCESS
+
+
+    def release(self):
+        if not isinstance(self.key, int):
+            winreg.CloseKey(self.key)
+        CloseHandle(HANDLE(self.event))
+
+
+
+class NotificationGroup(threading.Thread):
+    """Waits for up to MAXIMUM_WAIT_OBJECTS - 1 notifications and lets the watcher re-read the changed keys,
+    RESCAN_DELAY seconds after their first signal.
+    """
+
+
+    def __init__(self, watcher):
+        super().__init__(daemon=True)
+        self.watcher = watcher
+        self.notifications = []
+        self.pending = []
+        self.wake = CreateEvent(None, False, False, None)
+        self.stop = 0
+
+
+    def size(self):
+        return len(self.notifications) + len(self.pending)
+
+
+    def add(self, notification):
+        self.pending.append(notification)
+        SetEvent(HANDLE(self.wake))
+
+
+    def close(self):
+        self.stop = 1
+        SetEvent(HANDLE(self.wake))
+
+
+    def run(self):
+        # notification -> time of its first signal since its key was read
+        signaled = {}
+        while not self.stop:
+            while self.pending:
+                notification = self.pending.pop(0)
+                if notification.arm():
+                    self.notifications.append(notification)
+                else:
+                    notification.release()
+            for notification in [n for n in self.notifications if n.closed]:
+                self.notifications.remove(notification)
+                signaled.pop(notification, None)
+                notification.release()
+
+            timeout = INFINITE
+            if signaled:
+                timeout = max(0, int((min(signaled.values()) + RESCAN_DELAY - time.time()) * 1000))
+            handles = (HANDLE * (len(self.notifications) + 1))(self.wake, *[n.event for n in self.notifications])
+            ret = WaitForMultipleObjects(len(handles), handles, False, timeout)
+            if ret == WAIT_FAILED:
+                print('[!] ERROR: WaitForMultipleObjects() failed. Code: %x!' % (GetLastError(),), file=sys.stderr)
+                break
+            idx = ret - WAIT_OBJECT_0
+            if 0 < idx < len(handles):
+                notification = self.notifications[idx - 1]
+                # registered again before reading the key, changes made meanwhile signal it again
+                notification.arm()
+                signaled.setdefault(notification, time.time())
+
+            now = time.time()
+            for notification in [n for n, t in signaled.items() if now - t >= RESCAN_DELAY]:
+                del signaled[notification]
+                self.watcher.rescan(notification)
+
+        # the changes signaled before the stop are still logged
+        for notification in signaled:
+            self.watcher.rescan(notification)
+        for notification in self.notifications:
+            notification.release()
+        CloseHandle(HANDLE(self.wake))
 
 
 
 class RegistryWatcher():
 
 
-    def __init__(self, keys=(winreg.HKEY_LOCAL_MACHINE, winreg.HKEY_CURRENT_USER), exclude=whitelisted,
-            output=sys.stdout):
+    def __init__(self, keys=(winreg.HKEY_LOCAL_MACHINE, winreg.HKEY_CURRENT_USER), exclude=WHITELIST,
+            output=sys.stdout, compact=False, threads=REG_THREADS, timings=None):
+        """Args:
+            exclude: callable telling if a key path is excluded; a `Whitelist` also prunes fully excluded subtrees
+            timings: `Timings` in which every rescan is recorded
+        """
         self.keys = keys
+        self.compact = compact
+        self.threads = threads
         self.d = {}
         self.changes = []
         self.exclude = exclude
+        self.prune = getattr(exclude, 'prunes', None)
         self.output = output
+        self.stats = {'keys': 0, 'unchanged': 0}
+        self.lock = threading.Lock()
+        self.notifications = {}
+        self.groups = []
+        self.events = 0
+        self.started = None
+        self.timings = timings
 
 
     def snap(self, path=None, key=None):
-        if path is None:
+        if path is not None:
+            return self.__snap(path, key)
+
+        if self.threads <= 1:
             for k in self.keys:
-                self.d[k] = self.snap(RK_MAP[k], k)
+                self.d[k] = self.__snap(RK_MAP[k], k)
             return
-        d = {0: {}}
+
+        handles = []
+        with ThreadPoolExecutor(self.threads) as pool:
+            for k in self.keys:
+                self.d[k] = self.__snap_split(pool, RK_MAP[k], k, handles)
+            for k in self.keys:
+                _resolve(self.d[k])
+        for handle in handles:
+            winreg.CloseKey(handle)
+
+
+    def __node(self, key):
+        # 0: values, 1: (subkeys count, values count, last write time), other keys: subkeys
+        d = {0: {}, 1: winreg.QueryInfoKey(key)}
+        for name, val, _ in self.__values(key):
+            d[0][name] = compact_value(val) if self.compact else val
+        return d
+
+
+    def __snap(self, path, key):
+        d = self.__node(key)
+        for name in self.__subkeys(path, key):
+            try:
+                subkey = winreg.OpenKey(key, name)
+            except PermissionError:
+                continue
+            d[name] = self.__snap('%s/%s' % (path, name), subkey)
+            winreg.CloseKey(subkey)
+        return d
+
+
+    def __snap_split(self, pool, path, key, handles):
+        """Snapshots a key, while its subtrees (or the subtrees of its SPLIT_KEYS subkeys) are walked by the pool.
+        Subtrees are left as futures in the snapshot, see `_resolve`.
+        """
+        d = self.__node(key)
+        for name in self.__subkeys(path, key):
+            subpath = '%s/%s' % (path, name)
+            if subpath.upper() in SPLIT_KEYS:
+                try:
+                    subkey = winreg.OpenKey(key, name)
+                except PermissionError:
+                    continue
+                handles.append(subkey)
+                d[name] = self.__snap_split(pool, subpath, subkey, handles)
+            else:
+                d[name] = pool.submit(self.__subtree, self.__snap, key, name, subpath, PermissionError)
+        return d
+
+
+    def __subtree(self, func, key, name, path, errors, *args):
+        # runs on a worker thread, with its own handle of the subtree
+        try:
+            subkey = winreg.OpenKey(key, name)
+        except errors:
+            return None
+        try:
+            return func(path, subkey, *args)
+        finally:
+            winreg.CloseKey(subkey)
+
+
+    def __values(self, key):
+        values = []
         idx = 0
         while 1:
             try:
-                name, val, _ = winreg.EnumValue(key, idx)
+                values.append(winreg.EnumValue(key, idx))
             except OSError:
                 break
-            d[0][name] = val
             idx += 1
+        return values
+
+
+    def __subkeys(self, path, key):
+        names = []
+        if self.prune and self.prune(path):
+            return names
         idx = 0
         while 1:
             try:
                 name = winreg.EnumKey(key, idx)
             except OSError:
                 break
-            subpath = '%s/%s' % (path, name)
-            if self.exclude and self.exclude(subpath):
-                idx += 1
-                continue
+            idx += 1
+            if not self.exclude or not self.exclude('%s/%s' % (path, name)):
+                names.append(name)
+        return names
+
+
+    def __diff_values(self, path, old, values, changes):
+        newlst = []
+        for name, val, _ in values:
+            if name in old:
+                if old[name] != (compact_value(val) if self.compact else val):
+                    changes.append(('%s/%s' % (path, name), shown_value(old[name]), val))
+            else:
+                changes.append(('%s/%s' % (path, name), None, val))
+            newlst.append(name)
+        for k in old:
+            if type(old[k]) != dict and k not in newlst:
+                changes.append(('%s/%s' % (path, k), shown_value(old[k]), None))
+
+
+    def __diff_node(self, path, key, d, changes, stats):
+        """Diffs the values of a key.
+
+        Returns:
+            tuple of (subkey names to diff, errors of opening a subkey which are ignored)
+        """
+        stats['keys'] += 1
+        if d.get(1) == winreg.QueryInfoKey(key):
+            # writing/deleting a value or adding/removing a subkey updates the last write time of a key, so the
+            # values and subkeys list are the same as in the snapshot, only the subkeys themselves can differ
+            stats['unchanged'] += 1
+            return [name for name in d if name not in (0, 1)], OSError
+
+        self.__diff_values(path, d[0], self.__values(key), changes)
+        return self.__subkeys(path, key), PermissionError
+
+
+    def __diff(self, path, key, d, changes, stats):
+        names, errors = self.__diff_node(path, key, d, changes, stats)
+        for name in names:
             try:
                 subkey = winreg.OpenKey(key, name)
-            except PermissionError:
-                idx += 1
+            except errors:
                 continue
-            d[name] = self.snap(subpath, subkey)
+            self.__diff('%s/%s' % (path, name), subkey, d.get(name, {0: {}}), changes, stats)
             winreg.CloseKey(subkey)
-            idx += 1
-        return d
+
+
+    def __diff_task(self, path, key, d):
+        changes = []
+        stats = {'keys': 0, 'unchanged': 0}
+        self.__diff(path, key, d, changes, stats)
+        return changes, stats
+
+
+    def __diff_split(self, pool, path, key, d, parts, handles):
+        """Diffs a key, while its subtrees (or the subtrees of its SPLIT_KEYS subkeys) are diffed by the pool. The
+        changes of the key and the futures of the subtrees are added to `parts` in the order of a serial diff.
+        """
+        changes = []
+        parts.append(changes)
+        names, errors = self.__diff_node(path, key, d, changes, self.stats)
+        for name in names:
+            subpath = '%s/%s' % (path, name)
+            if subpath.upper() in SPLIT_KEYS:
+                try:
+                    subkey = winreg.OpenKey(key, name)
+                except errors:
+                    continue
+                handles.append(subkey)
+                self.__diff_split(pool, subpath, subkey, d.get(name, {0: {}}), parts, handles)
+            else:
+                parts.append(pool.submit(self.__subtree, self.__diff_task, key, name, subpath, errors,
+                        d.get(name, {0: {}})))
 
 
     def diff(self, path=None, key=None, d=None):
-        if key is None:
+        if key is not None:
+            self.__diff(path, key, d, self.changes, self.stats)
+            return self.changes
+
+        if self.threads <= 1:
             for k in self.d:
-                self.diff(RK_MAP[k], k, self.d[k])
+                self.__diff(RK_MAP[k], k, self.d[k], self.changes, self.stats)
             return self.changes
-        idx = 0
-        newlst = []
-        while 1:
+
+        parts = []
+        handles = []
+        with ThreadPoolExecutor(self.threads) as pool:
+            for k in self.d:
+                self.__diff_split(pool, RK_MAP[k], k, self.d[k], parts, handles)
+            for part in parts:
+                if isinstance(part, list):
+                    self.changes.extend(part)
+                    continue
+                result = part.result()
+                if result is not None:
+                    self.changes.extend(result[0])
+                    for stat in self.stats:
+                        self.stats[stat] += result[1][stat]
+        for handle in handles:
+            winreg.CloseKey(handle)
+        return self.changes
+
+
+    def __refresh(self, path, key, d, changes):
+        """Updates in place the snapshot `d` of a subtree, reading again only the values and subkeys lists of the keys
+        whose last write time changed.
+        """
+        info = winreg.QueryInfoKey(key)
+        if d.get(1) == info:
+            names = [name for name in d if name not in (0, 1)]
+        else:
+            new = self.__node(key)
+            compare(path, {0: d[0]}, {0: new[0]}, changes)
+            d.update(new)
+            names = self.__subkeys(path, key)
+            for name in [n for n in d if n not in (0, 1) and n not in names]:
+                compare('%s/%s' % (path, name), d.pop(name), None, changes)
+
+        for name in names:
+            subpath = '%s/%s' % (path, name)
             try:
-                name, val, _ = winreg.EnumValue(key, idx)
+                subkey = winreg.OpenKey(key, name)
             except OSError:
-                break
-            if name in d[0]:
-                if d[0][name] != val:
-                    self.changes.append(('%s/%s' % (path, name), d[0][name], val))
-            else:
-                self.changes.append(('%s/%s' % (path, name), None, val))
-            newlst.append(name)
-            idx += 1
-        for k in d[0]:
-            if type(d[0][k]) != dict and k not in newlst:
-                self.changes.append(('%s/%s' % (path, k), d[0][k], None))
-        idx = 0
-        while 1:
+                continue
             try:
-                name = winreg.EnumKey(key, idx)
+                if name in d:
+                    self.__refresh(subpath, subkey, d[name], changes)
+                else:
+                    d[name] = self.__snap(subpath, subkey)
+                    compare(subpath, None, d[name], changes)
             except OSError:
-                break
-            subpath = '%s/%s' % (path, name)
-            if self.exclude and self.exclude(subpath):
-                idx += 1
-                continue
+                # deleted meanwhile, seen on the next signal of the notification
+                pass
+            finally:
+                winreg.CloseKey(subkey)
+
+
+    def __notify(self, path, key, parent, name, subtree):
+        notification = RegistryNotification(path, key, parent, name, subtree)
+        self.notifications[path] = notification
+        group = next((g for g in self.groups if g.size() < MAXIMUM_WAIT_OBJECTS - 1), None)
+        if group is None:
+            group = NotificationGroup(self)
+            self.groups.append(group)
+            group.start()
+        group.add(notification)
+
+
+    def __notify_split(self, path, key, parent, name):
+        self.__notify(path, key, parent, name, False)
+        d = parent[name]
+        for subname in [n for n in d if n not in (0, 1)]:
+            subpath = '%s/%s' % (path, subname)
             try:
-                subkey = winreg.OpenKey(key, name)
-            except PermissionError:
-                idx += 1
+                subkey = winreg.OpenKey(key, subname)
+            except OSError:
                 continue
-            self.diff(subpath, subkey, d.get(name, {0: {}}))
-            winreg.CloseKey(subkey)
-            idx += 1
+            if subpath.upper() in SPLIT_KEYS:
+                self.__notify_split(subpath, subkey, d, subname)
+            else:
+                self.__notify(subpath, subkey, d, subname, True)
+
+
+    def start_notifications(self):
+        """Logs the registry changes as they happen, with the seconds passed since this call. Every subtree walked
+        by its own thread in `snap` gets a change notification (RegNotifyChangeKeyValue) and is read again when it
+        changes. The snapshot is kept up to date, so `show_diff` afterwards only shows the changes which were missed.
+        """
+        self.started = time.time()
+        for k in self.d:
+            self.__notify_split(RK_MAP[k], k, self.d, k)
+
+
+    def stop_notifications(self):
+        """Stops the notifications, waiting for the running rescans, so the snapshot is not changed afterwards.
+        """
+        for group in self.groups:
+            group.close()
+        for group in self.groups:
+            group.join()
+        self.groups = []
+
+
+    def rescan(self, notification):
+        """Reads again the key of a signaled notification and logs its changes.
+        """
+        with self.lock:
+            if notification.closed:
+                return
+            start = time.time()
+            t = start - self.started
+            changes = []
+            old = notification.parent.get(notification.name)
+            try:
+                if notification.subtree and old is not None:
+                    # only the keys written since the last read are read again
+                    self.__refresh(notification.path, notification.key, old, changes)
+                    new = old
+                elif notification.subtree:
+                    new = self.__snap(notification.path, notification.key)
+                else:
+                    new = self.__node(notification.key)
+                    subkeys = self.__subkeys(notification.path, notification.key)
+            except OSError:
+                # the key was deleted
+                new = None
+
+            if notification.subtree and new is old:
+                pass
+            elif notification.subtree or new is None or old is None:
+                compare(notification.path, old, new, changes)
+                if new is None:
+                    notification.parent.pop(notification.name, None)
+                    self.notifications.pop(notification.path, None)
+                    notification.closed = True
+                else:
+                    notification.parent[notification.name] = new
+            else:
+                compare(notification.path, {0: old[0]}, {0: new[0]}, changes)
+                for name in [n for n in old if n not in (0, 1) and n not in subkeys]:
+                    compare('%s/%s' % (notification.path, name), old.pop(name), None, changes)
+                    if '%s/%s' % (notification.path, name) in self.notifications:
+                        self.notifications.pop('%s/%s' % (notification.path, name)).closed = True
+                for name in [n for n in subkeys if n not in old]:
+                    subpath = '%s/%s' % (notification.path, name)
+                    try:
+                        subkey = winreg.OpenKey(notification.key, name)
+                        old[name] = self.__snap(subpath, subkey)
+                    except OSError:
+                        continue
+                    compare(subpath, None, old[name], changes)
+                    self.__notify(subpath, subkey, old, name, True)
+                for i in (0, 1):
+                    if i in new:
+                        old[i] = new[i]
+
+            for path, old_val, new_val in changes:
+                self.events += 1
+                self.__print('+%.3f sec. %s' % (t, format_change(path, old_val, new_val)))
+            if self.timings:
+                self.timings.add('registry_rescan', start, time.time(), key=notification.path, changes=len(changes))
+
+
+    def __print(self, line):
+        try:
+            print(line, file=self.output)
+        except Exception as e:
+            print('%s\nERROR: %s\n%s' % ('=' * 20, str(e), '=' * 20), file=self.output)
 
 
     def show_diff(self):
         diff = self.diff()
         for path, old, new in diff:
-            if old is None:
-                op = 'created: [%s]' % new
-            elif new is None:
-                op = 'deleted (was [%s])' % old
-            else:
-                op = 'changed: [%s] -> [%s]' % (old, new)
-            try:
-                print('[%s]: %s' % (path, op), file=self.output)
-            except Exception as e:
-                print('%s\nERROR: %s\n%s' % ('=' * 20, str(e), '=' * 20), file=self.output)
+            self.__print(format_change(path, old, new))
 
         if self.output is not sys.stdout:
             self.output.close()
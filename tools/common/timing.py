@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Timing of the phases of an experiment, used on the guest (clientapp.py) and on the host (VBoxMachine).
+
+Every phase is recorded as a span (name, start, end, duration, thread, arguments); the spans of the guest are merged
+with the host ones in the `timings.json` of the results, which can also be exported as a Chrome trace
+(chrome://tracing, Perfetto).
+"""
+
+import math
+import time
+import threading
+
+from contextlib import contextmanager
+
+
+# percentiles shown for every phase over a set of runs
+PERCENTILES = (50, 90, 99)
+
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of the (non empty) values.
+    """
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def phase_percentiles(durations, points=PERCENTILES):
+    """Aggregates the phase durations of several runs.
+
+    Args:
+        durations (dict): phase -> list of its durations (one per run)
+
+    Returns:
+        dict of phase -> dict with the number of runs and the percentiles (`p50`, ...) and maximum of its duration
+    """
+    stats = {}
+    for phase, values in durations.items():
+        if not values:
+            continue
+        stats[phase] = {'runs': len(values), 'max': max(values)}
+        stats[phase].update({'p%d' % (p,): percentile(values, p) for p in points})
+    return stats
+
+
+
+class Timings():
+    """Spans of the phases of a run, recorded from any thread.
+
+    Usage:
+        with timings.span('registry_snap') as span:
+            ...
+        print(span['duration'])
+    """
+
+
+    def __init__(self, process='host'):
+        self.process = process
+        self.spans = []
+        self.lock = threading.Lock()
+
+
+    def add(self, name, start, end, process=None, **args):
+        span = {
+            'name': name,
+            'process': process or self.process,
+            'thread': threading.current_thread().name,
+            'start': start,
+            'end': end,
+            'duration': end - start
+        }
+        if args:
+            span['args'] = args
+        with self.lock:
+            self.spans.append(span)
+        return span
+
+
+    @contextmanager
+    def span(self, name, **args):
+        span = {'name': name, 'duration': 0}
+        start = time.time()
+        try:
+            yield span
+        finally:
+            span.update(self.add(name, start, time.time(), **args))
+
+
+    def timed(self, name, func):
+        """Returns:
+            function calling `func` in a span, e.g. to time a task submitted to a pool
+        """
+        def wrapper(*args, **kwargs):
+            with self.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+    def merge(self, spans, offset=0):
+        """Adds the spans recorded by another process, moved by `offset` seconds (e.g. to align the guest clock with
+        the host one).
+        """
+        with self.lock:
+            for span in spans:
+                span = dict(span, start=span['start'] + offset, end=span['end'] + offset)
+                self.spans.append(span)
+
+
+    def phases(self):
+        """Returns:
+            dict of span name -> total duration (for the spans of the same name)
+        """
+        phases = {}
+        with self.lock:
+            for span in self.spans:
+                phases[span['name']] = phases.get(span['name'], 0) + span['duration']
+        return phases
+
+
+    def to_json(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        return {'spans': spans, 'phases': self.phases()}
+
+
+    def chrome_trace(self):
+        """Returns:
+            dict in the Trace Event Format: one complete event per span, processes and threads as trace rows
+        """
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span['start'])
+        t0 = spans[0]['start'] if spans else 0
+        events = []
+        for span in spans:
+            events.append({
+                'name': span['name'],
+                'ph': 'X',
+                'ts': int((span['start'] - t0) * 1e6),
+                'dur': int(span['duration'] * 1e6),
+                'pid': span['process'],
+                'tid': span['thread'],
+                'args': span.get('args', {})
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
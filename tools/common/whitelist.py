@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import re
+import fnmatch
+
+
+
+class Whitelist():
+    """Registry paths excluded from monitoring, given as `fnmatch` patterns (case insensitive, `*` also matches `/`).
+
+    Patterns are compiled once: `<key>/*` patterns, which exclude a whole subtree, are kept in a set of prefixes and
+    checked once per path level, the other patterns are combined in a single regex.
+    """
+
+
+    def __init__(self, patterns=()):
+        self.prefixes = set()
+        others = []
+        for pattern in patterns:
+            pattern = pattern.strip().lower().replace('\\', '/')
+            if not pattern:
+                continue
+            if pattern.endswith('/*') and not any(c in pattern[:-2] for c in '*?['):
+                self.prefixes.add(pattern[:-2])
+            else:
+                others.append(pattern)
+        self.regex = re.compile('|'.join(fnmatch.translate(p) for p in others)).match if others else None
+
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn) as fr:
+            return cls(fr.readlines())
+
+
+    def __call__(self, path):
+        return self.matches(path)
+
+
+    def __prefixed(self, pth):
+        idx = pth.find('/')
+        while idx != -1:
+            if pth[:idx] in self.prefixes:
+                return True
+            idx = pth.find('/', idx + 1)
+        return False
+
+
+    def matches(self, path):
+        pth = path.lower().replace('\\', '/')
+        if self.prefixes and self.__prefixed(pth):
+            return True
+        return bool(self.regex and self.regex(pth))
+
+
+    def prunes(self, path):
+        """Checks if all the subkeys of a path are excluded, so its subtree does not have to be walked.
+        """
+        return bool(self.prefixes) and self.__prefixed(path.lower().replace('\\', '/') + '/')
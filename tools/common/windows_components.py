@@ -1,5 +1,6 @@
-from ctypes import c_void_p, c_long, c_ulong, c_char, c_ushort, c_ubyte, c_wchar
-from ctypes import windll, Structure, sizeof, POINTER, byref, create_string_buffer, memset, cast    # NOQA
+from ctypes import c_void_p, c_long, c_ulong, c_char, c_ushort, c_ubyte, c_wchar, c_size_t
+from ctypes import windll, Structure, sizeof, POINTER, byref, create_string_buffer, create_unicode_buffer, memset, \
+        cast    # NOQA
 
 
 # Windows constants
@@ -12,6 +13,7 @@ LPBYTE = POINTER(c_ubyte)
 LONG = c_long
 CHAR = c_char
 WCHAR = c_wchar
+SIZE_T = c_size_t
 if sizeof(c_void_p) == 8:
     from ctypes import c_longlong
     ULONG_PTR = c_longlong
@@ -25,12 +27,16 @@ CREATE_SUSPENDED = 0x00000004
 TH32CS_SNAPPROCESS = 0x00000002
 TH32CS_SNAPTHREAD = 0x00000004
 THREAD_SUSPEND_RESUME = 0x0002
+PROCESS_SUSPEND_RESUME = 0x0800
+PROCESS_VM_READ = 0x0010
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
 
 GENERIC_READ = 0x80000000
 FILE_SHARE_READ = 0x00000001
 FILE_SHARE_WRITE = 0x00000002
 OPEN_EXISTING = 0x3
 FILE_FLAG_BACKUP_SEMANTICS = 0x02000000
+FILE_FLAG_OVERLAPPED = 0x40000000
 FILE_NOTIFY_CHANGE_FILE_NAME = 0x00000001
 FILE_NOTIFY_CHANGE_DIR_NAME = 0x00000002
 FILE_NOTIFY_CHANGE_ATTRIBUTES = 0x00000004
@@ -39,6 +45,19 @@ FILE_NOTIFY_CHANGE_LAST_WRITE = 0x00000010
 FILE_NOTIFY_CHANGE_CREATION = 0x00000040
 FILE_NOTIFY_CHANGE_SECURITY = 0x00000100
 
+REG_NOTIFY_CHANGE_NAME = 0x00000001
+REG_NOTIFY_CHANGE_ATTRIBUTES = 0x00000002
+REG_NOTIFY_CHANGE_LAST_SET = 0x00000004
+REG_NOTIFY_CHANGE_SECURITY = 0x00000008
+
+INFINITE = 0xFFFFFFFF
+WAIT_OBJECT_0 = 0x00000000
+WAIT_FAILED = 0xFFFFFFFF
+MAXIMUM_WAIT_OBJECTS = 64
+ERROR_SUCCESS = 0x0
+WAIT_TIMEOUT = 0x00000102
+ERROR_OPERATION_ABORTED = 0x3E3
+ERROR_NOTIFY_ENUM_DIR = 0x3FE
 
 MAX_PATH = 0x00000104
 INVALID_HANDLE_VALUE = -1
@@ -111,6 +130,23 @@ class THREADENTRY32(Structure):
 
 
 
+class PROCESS_MEMORY_COUNTERS_EX(Structure):
+    _fields_ = [
+        ('cb',                          DWORD),
+        ('PageFaultCount',              DWORD),
+        ('PeakWorkingSetSize',          SIZE_T),
+        ('WorkingSetSize',              SIZE_T),
+        ('QuotaPeakPagedPoolUsage',     SIZE_T),
+        ('QuotaPagedPoolUsage',         SIZE_T),
+        ('QuotaPeakNonPagedPoolUsage',  SIZE_T),
+        ('QuotaNonPagedPoolUsage',      SIZE_T),
+        ('PagefileUsage',               SIZE_T),
+        ('PeakPagefileUsage',           SIZE_T),
+        ('PrivateUsage',                SIZE_T)
+    ]
+
+
+
 class FILE_NOTIFY_INFORMATION(Structure):
     _fields_ = [
         ('NextEntryOffset', DWORD),
@@ -124,6 +160,20 @@ PFILE_NOTIFY_INFORMATION = POINTER(FILE_NOTIFY_INFORMATION)
 
 
 
+class OVERLAPPED(Structure):
+    _fields_ = [
+        ('Internal',        ULONG_PTR),
+        ('InternalHigh',    ULONG_PTR),
+        ('Offset',          DWORD),
+        ('OffsetHigh',      DWORD),
+        ('hEvent',          HANDLE)
+    ]
+
+
+LPOVERLAPPED = POINTER(OVERLAPPED)
+
+
+
 # Windows function headers
 
 CreateProcess = windll.kernel32.CreateProcessW
@@ -137,6 +187,22 @@ CloseHandle = windll.kernel32.CloseHandle
 Thread32First = windll.kernel32.Thread32First
 Thread32Next = windll.kernel32.Thread32Next
 OpenThread = windll.kernel32.OpenThread
+OpenProcess = windll.kernel32.OpenProcess
+OpenProcess.restype = HANDLE
+NtSuspendProcess = windll.ntdll.NtSuspendProcess
+GetProcessMemoryInfo = windll.psapi.GetProcessMemoryInfo
 TerminateProcess = windll.kernel32.TerminateProcess
 CreateFile = windll.kernel32.CreateFileW
 ReadDirectoryChangesW = windll.kernel32.ReadDirectoryChangesW
+CreateEvent = windll.kernel32.CreateEventW
+CreateEvent.restype = HANDLE
+SetEvent = windll.kernel32.SetEvent
+WaitForMultipleObjects = windll.kernel32.WaitForMultipleObjects
+WaitForMultipleObjects.restype = DWORD
+WaitForSingleObject = windll.kernel32.WaitForSingleObject
+WaitForSingleObject.restype = DWORD
+RegNotifyChangeKeyValue = windll.advapi32.RegNotifyChangeKeyValue
+CreateIoCompletionPort = windll.kernel32.CreateIoCompletionPort
+CreateIoCompletionPort.restype = HANDLE
+GetQueuedCompletionStatus = windll.kernel32.GetQueuedCompletionStatus
+CancelIoEx = windll.kernel32.CancelIoEx
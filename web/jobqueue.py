@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import time
+import sqlite3
+import threading
+
+
+JOB_STATUSES = ('pending', 'running', 'done', 'failed')
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    vm_name TEXT,
+    vm_snapshot TEXT,
+    vm_username TEXT,
+    vm_password TEXT,
+    malware_file TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    force INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    assigned_vm TEXT,
+    response TEXT,
+    result_dir TEXT,
+    created REAL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, priority DESC, id);
+CREATE TABLE IF NOT EXISTS vms (
+    name TEXT PRIMARY KEY,
+    snapshot TEXT,
+    username TEXT,
+    password TEXT
+);
+'''
+
+
+
+class JobQueue:
+    """Persistent queue of experiments, backed by a SQLite database.
+
+    A job either targets a specific VM (`vm_name`) or any registered VM, in which case the snapshot and credentials
+    registered for that VM are used. Jobs with higher priority are handed out first, FIFO for equal priorities.
+    """
+
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+
+        with self.__connect() as db:
+            db.executescript(SCHEMA)
+            # databases created before the `force` column existed
+            columns = [r['name'] for r in db.execute('PRAGMA table_info(jobs)')]
+            if 'force' not in columns:
+                db.execute('ALTER TABLE jobs ADD COLUMN force INTEGER NOT NULL DEFAULT 0')
+
+
+    def __connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        return db
+
+
+    def register_vm(self, name, snapshot, username, password):
+        with self.lock, self.__connect() as db:
+            db.execute('INSERT OR REPLACE INTO vms (name, snapshot, username, password) VALUES (?, ?, ?, ?)',
+                    (name, snapshot, username, password))
+
+
+    def unregister_vm(self, name):
+        with self.lock, self.__connect() as db:
+            db.execute('DELETE FROM vms WHERE name = ?', (name,))
+
+
+    def vms(self):
+        with self.__connect() as db:
+            return [dict(r) for r in db.execute('SELECT * FROM vms ORDER BY name')]
+
+
+    def submit(self, malware_file, vm_name=None, vm_snapshot=None, vm_username=None, vm_password=None, priority=0,
+            force=False):
+        """Adds a new pending job.
+
+        Returns:
+            int: ID of the new job
+        """
+        with self.lock, self.__connect() as db:
+            cursor = db.execute('INSERT INTO jobs (vm_name, vm_snapshot, vm_username, vm_password, malware_file, '
+                    'priority, force, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (vm_name or None, vm_snapshot,
+                    vm_username, vm_password, malware_file, int(priority or 0), int(bool(force)), time.time()))
+            return cursor.lastrowid
+
+
+    def submit_done(self, malware_file, vm_name, result_dir, response='cached'):
+        """Adds a job which needs no run, its results being already available (i.e. cached).
+
+        Returns:
+            int: ID of the new job
+        """
+        now = time.time()
+        with self.lock, self.__connect() as db:
+            cursor = db.execute('INSERT INTO jobs (vm_name, malware_file, status, assigned_vm, response, result_dir, '
+                    'created, started, finished) VALUES (?, ?, \'done\', ?, ?, ?, ?, ?, ?)', (vm_name, malware_file,
+                    vm_name, response, result_dir, now, now, now))
+            return cursor.lastrowid
+
+
+    def claim(self, vm_name):
+        """Marks as running the next pending job which can be executed on the given VM.
+
+        Returns:
+            dict: the claimed job or None if there is nothing to run on the VM
+        """
+        with self.lock, self.__connect() as db:
+            row = db.execute('SELECT * FROM jobs WHERE status = \'pending\' AND (vm_name IS NULL OR vm_name = ?) '
+                    'ORDER BY priority DESC, id LIMIT 1', (vm_name,)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE jobs SET status = \'running\', assigned_vm = ?, started = ? WHERE id = ?',
+                    (vm_name, time.time(), row['id']))
+
+        job = dict(row)
+        job.update({'status': 'running', 'assigned_vm': vm_name})
+        return job
+
+
+    def finish(self, job_id, status, response, result_dir=None):
+        with self.lock, self.__connect() as db:
+            db.execute('UPDATE jobs SET status = ?, response = ?, result_dir = ?, finished = ? WHERE id = ?',
+                    (status, response, result_dir, time.time(), job_id))
+
+
+    def set_result_dir(self, job_id, result_dir):
+        with self.lock, self.__connect() as db:
+            db.execute('UPDATE jobs SET result_dir = ? WHERE id = ?', (result_dir, job_id))
+
+
+    def requeue_running(self):
+        """Puts back in the queue the jobs interrupted by a server restart.
+
+        Returns:
+            int: number of requeued jobs
+        """
+        with self.lock, self.__connect() as db:
+            return db.execute('UPDATE jobs SET status = \'pending\', assigned_vm = NULL, started = NULL '
+                    'WHERE status = \'running\'').rowcount
+
+
+    def get(self, job_id):
+        with self.__connect() as db:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+
+    def latest(self):
+        with self.__connect() as db:
+            row = db.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT 1').fetchone()
+        return dict(row) if row else None
+
+
+    def jobs(self, limit=50):
+        with self.__connect() as db:
+            return [dict(r) for r in db.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,))]
@@ -11,11 +11,15 @@ import bottle
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + '/..')
 
 import lib.vboxmachine as vboxmachine   # NOQA
+from lib.vmfarm import VMFarm   # NOQA
 from exception import VBoxLibException  # NOQA
+from lib.ingest import ingestion_status, PHASES_FN  # NOQA
+from jobqueue import JobQueue   # NOQA
 
 
 PROJECT_DIR = os.path.dirname(os.path.realpath(__file__)) + '/..'
-TASKS = []
+QUEUE = JobQueue(os.path.join(PROJECT_DIR, 'jobs.db'))
+SCHEDULER = None
 
 
 
@@ -42,42 +46,131 @@ class LogFile:
 class ExperimentTask(threading.Thread):
 
 
-    def __init__(self, vm_name, vm_snapshot, vm_username, vm_password, malware_file):
+    def __init__(self, job, vm, on_finish=None, on_release=None):
         super().__init__()
-        self.name = vm_name
-        self.snapshot = vm_snapshot
-        self.username = vm_username
-        self.password = vm_password
-        self.sample = malware_file
+        self.job_id = job['id']
+        self.name = vm['name']
+        self.snapshot = job['vm_snapshot'] or vm['snapshot']
+        self.username = job['vm_username'] or vm['username']
+        self.password = job['vm_password'] or vm['password']
+        self.sample = job['malware_file']
+        self.force = bool(job['force'])
+        self.on_finish = on_finish
+        # called once the VM is powered off, while the results are ingested
+        self.on_release = on_release
         self.finish = False
+        self.status = 'done'
         self.response = 'done'
+        self.result_dir = None
 
 
     def run(self):
         try:
-            vbx = vboxmachine.VBoxMachine(self.name, self.snapshot, self.username, self.password, self.sample)
-
-            vbx.restore_snapshot()
-            vbx.launch()
-            vbx.deploy_necessary_files()
-            vbx.launch_client_app()
-            vbx.power_off()
-        except VBoxLibException as e:
-            try:
-                vbx.power_off()
-            except Exception:
-                pass
+            vbx = vboxmachine.VBoxMachine(self.name, self.snapshot, self.username, self.password, self.sample,
+                    use_cache=not self.force)
+            self.result_dir = vbx.run()
+            if vbx.cached:
+                self.response = 'cached'
+            if self.on_release:
+                self.on_release(self)
+            ingestion = vbx.wait_ingestion()
+            if ingestion and ingestion['status'] != 'done':
+                self.status = 'failed'
+                self.response = 'ingestion failed: %s' % (ingestion.get('error'),)
+        except Exception as e:
+            self.status = 'failed'
             self.response = str(e)
 
         self.finish = True
+        if self.on_finish:
+            self.on_finish(self)
+
+
+
+class Scheduler(threading.Thread):
+    """Hands out the pending jobs of the queue to the registered VMs, as soon as they are free.
+    """
+
+
+    def __init__(self, queue, interval=5):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.interval = interval
+        self.running = {}
+        self.wakeup = threading.Event()
+
+
+    def notify(self):
+        self.wakeup.set()
+
+
+    def __vm_released(self, task):
+        if self.running.get(task.name) is task:
+            self.running.pop(task.name)
+            self.notify()
+
+
+    def __task_released(self, task):
+        # the ingestion status of the job can be followed from now on
+        if task.result_dir:
+            self.queue.set_result_dir(task.job_id, os.path.basename(task.result_dir))
+        self.__vm_released(task)
+
+
+    def __task_finished(self, task):
+        self.queue.finish(task.job_id, task.status, task.response,
+                os.path.basename(task.result_dir) if task.result_dir else None)
+        print('[#] Job [%d] finished on [%s]: %s' % (task.job_id, task.name, task.response))
+        self.__vm_released(task)
+
+
+    def schedule(self):
+        for vm in self.queue.vms():
+            if vm['name'] in self.running:
+                continue
+            job = self.queue.claim(vm['name'])
+            if job is None:
+                continue
+            print('[#] Job [%d] (%s) assigned to [%s]' % (job['id'], job['malware_file'], vm['name']))
+            task = ExperimentTask(job, vm, on_finish=self.__task_finished, on_release=self.__task_released)
+            self.running[vm['name']] = task
+            task.start()
+
+
+    def run(self):
+        requeued = self.queue.requeue_running()
+        if requeued:
+            print('[#] %d interrupted job(s) put back in queue' % (requeued,))
+        while 1:
+            try:
+                self.schedule()
+            except Exception as e:
+                print('[!] ERROR: scheduler: %s' % (str(e),))
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
 
 
+def start_webapp(interface='0.0.0.0', port=8080, logfile='webapp.log', vms=()):
+    global SCHEDULER
 
-def start_webapp(interface='0.0.0.0', port=8080, logfile='webapp.log'):
     if not os.path.isdir('logs'):
         os.mkdir('logs')
 
     sys.stdout = sys.stderr = LogFile(os.path.join('logs', logfile))
+
+    for vm in vms:
+        if vm.get('farm'):
+            # linked clones of the VM are the workers
+            farm = VMFarm(vm['name'], vm.get('snapshot'))
+            farm.create(int(vm['farm']))
+            for worker in farm.workers():
+                QUEUE.register_vm(worker['name'], worker['snapshot'], vm.get('username'), vm.get('password'))
+        else:
+            QUEUE.register_vm(vm['name'], vm.get('snapshot'), vm.get('username'), vm.get('password'))
+
+    SCHEDULER = Scheduler(QUEUE)
+    SCHEDULER.start()
     bottle.run(host=interface, port=port)
 
 
@@ -106,28 +199,98 @@ def available_reports():
     return sorted(results, key=lambda x: x['date'], reverse=True)
 
 
+def timing_percentiles():
+    """Returns:
+        list of (phase, stats) tuples, the percentiles of the phase durations over the latest runs (updated by the
+            ingestion of every run)
+    """
+    try:
+        return sorted(json.loads(open(PHASES_FN).read())['stats'].items())
+    except Exception:
+        return []
+
+
+def cached_result(args):
+    """Looks for the results of the same experiment in the cache, on the requested VM or on any registered one.
+
+    Returns:
+        tuple of (VM name, result directory) or None if the experiment has to run
+    """
+    for vm in QUEUE.vms():
+        if args.get('vm_name') and vm['name'] != args['vm_name']:
+            continue
+        try:
+            vbx = vboxmachine.VBoxMachine(vm['name'], args.get('vm_snapshot') or vm['snapshot'],
+                    args.get('vm_username') or vm['username'], args.get('vm_password') or vm['password'],
+                    args['malware_file'])
+            result_dir = vbx.cached_result()
+        except Exception:
+            continue
+        if result_dir:
+            return vm['name'], result_dir
+    return None
+
+
 def run_experiment(args):
-    if TASKS and TASKS[-1].finish:
-        t = ExperimentTask(**args)
-        TASKS.append(t)
-        t.start()
-        return 200, 'ok'
-    elif not TASKS:
-        t = ExperimentTask(**args)
-        TASKS.append(t)
-        t.start()
-        return 200, 'ok'
-    else:
-        return 400, 'Task already in progess!'
+    if not args.get('malware_file'):
+        return 400, 'No malware sample specified!'
+
+    vm_name = args.get('vm_name')
+    if vm_name:
+        known = [vm['name'] for vm in QUEUE.vms()]
+        if vm_name not in known:
+            if not (args.get('vm_username') and args.get('vm_password')):
+                return 400, 'VM [%s] is not registered, username and password are needed!' % (vm_name,)
+            QUEUE.register_vm(vm_name, args.get('vm_snapshot'), args['vm_username'], args['vm_password'])
+    elif not QUEUE.vms():
+        return 400, 'There are no VMs registered!'
+
+    try:
+        priority = int(args.get('priority') or 0)
+    except ValueError:
+        return 400, 'Priority should be an integer!'
+
+    cached = cached_result(args) if not args.get('force') else None
+    if cached:
+        print('[#] [%s] already analyzed on [%s], results: [%s]' % (os.path.basename(args['malware_file']),
+                cached[0], cached[1]))
+        return 200, QUEUE.submit_done(args['malware_file'], cached[0], os.path.basename(cached[1]))
+
+    job_id = QUEUE.submit(args['malware_file'], vm_name, args.get('vm_snapshot'), args.get('vm_username'),
+            args.get('vm_password'), priority, args.get('force'))
+    if SCHEDULER:
+        SCHEDULER.notify()
+
+    return 200, job_id
+
+
+def job_status(job):
+    """Returns:
+        dict: status of a job of the queue, as shown by the web interface
+    """
+    ingestion = ingestion_status(os.path.join(PROJECT_DIR, 'results', job['result_dir'])) if job['result_dir'] else None
+
+    return {
+        'job': job['id'],
+        'status': job['status'],
+        'response': job['response'] or '',
+        'vm': job['assigned_vm'] or job['vm_name'] or '',
+        'sample': os.path.basename(job['malware_file']),
+        'priority': job['priority'],
+        'result': job['result_dir'] or '',
+        'ingestion': ingestion['status'] if ingestion else ''
+    }
 
 
-def get_status_experiment():
-    if TASKS:
-        if TASKS[-1].finish:
-            return 200, TASKS[-1].response
-        else:
-            return 200, 'in progress'
-    return 200, 'no tasks'
+def get_status_experiment(job_id=None):
+    job = QUEUE.get(job_id) if job_id is not None else QUEUE.latest()
+    if job is None:
+        return (404, {'status': 'no such job'}) if job_id is not None else (200, {'status': 'no tasks'})
+    return 200, job_status(job)
+
+
+def list_jobs(limit=50):
+    return [job_status(job) for job in QUEUE.jobs(limit)]
 
 
 def get_experiment_report(report_path):
@@ -137,5 +300,7 @@ def get_experiment_report(report_path):
     rsp.update(json.loads(open(os.path.join(report_path, 'info.json')).read()))
     rsp.update({'folders': open(os.path.join(report_path, 'logs', 'folder_changes.txt')).read().split('\n')})
     rsp.update({'registry': open(os.path.join(report_path, 'logs', 'registry_changes.txt')).read().split('\n')})
+    detonation_fn = os.path.join(report_path, 'logs', 'detonation.json')
+    rsp['detonation'] = json.loads(open(detonation_fn).read()) if os.path.isfile(detonation_fn) else None
 
     return rsp
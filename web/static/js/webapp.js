@@ -1,21 +1,96 @@
+function show_status(text) {
+    document.getElementById('exp_status_text').style.display = 'block';
+    document.getElementById('exp_status_text').innerText = text;
+    setTimeout(() => {
+        document.getElementById('exp_status_text').style.display = 'none';
+    }, 5000);
+}
+
+function job_cell(row, text) {
+    let cell = document.createElement("td");
+    cell.textContent = text;
+    row.appendChild(cell);
+    return cell;
+}
+
+function refresh_jobs() {
+    let xhttp = new XMLHttpRequest();
+    xhttp.onreadystatechange = function() {
+        if (this.readyState == 4 && this.status == 200) {
+            // the sample names and error messages are not markup
+            let rows = document.createDocumentFragment();
+            JSON.parse(this.responseText)['jobs'].forEach((job) => {
+                let row = document.createElement("tr");
+                ['job', 'sample', 'vm', 'priority', 'status'].forEach((field) => job_cell(row, job[field]));
+                if (job['result']) {
+                    let link = document.createElement("a");
+                    link.href = "/experiment/" + encodeURIComponent(job['result']);
+                    link.target = "_blank";
+                    link.textContent = job['result'];
+                    job_cell(row, "").appendChild(link);
+                } else {
+                    job_cell(row, job['response']);
+                }
+                rows.appendChild(row);
+            });
+            let content = document.getElementById("jobs_content");
+            content.textContent = "";
+            content.appendChild(rows);
+        }
+    };
+    xhttp.open("GET", "/experiment/jobs");
+    xhttp.send();
+}
+
+function watch_job(job_id) {
+    var myinterval;
+
+    document.getElementById("status_exp").style.display = 'block';
+    myinterval = setInterval(() => {
+        let xhttp = new XMLHttpRequest();
+        xhttp.onreadystatechange = function() {
+            if (this.readyState == 4) {
+                if (this.status == 200) {
+                    let job = JSON.parse(this.responseText);
+                    if (job['status'] == 'done' || job['status'] == 'failed') {
+                        clearInterval(myinterval);
+                        document.getElementById("status_exp").style.display = 'none';
+                        show_status('Job ' + job_id + ': ' + job['response']);
+                    }
+                } else {
+                    clearInterval(myinterval);
+                    alert(this.responseText);
+                }
+                refresh_jobs();
+            }
+        };
+        xhttp.open("GET", "/experiment/job/" + job_id);
+        xhttp.send();
+    }, 2000);
+}
+
 function create_exp(form) {
 
     document.getElementById("button_exp").disabled = true;
-    document.getElementById("status_exp").style.display = 'block';
 
-    var myinterval;
     let args = {
         "vm_name": document.getElementById("vm_name").value,
         "vm_snapshot": document.getElementById("vm_snapshot").value,
         "vm_username": document.getElementById("vm_username").value,
         "vm_password": document.getElementById("vm_password").value,
-        "malware_file": document.getElementById("malware_file").value
+        "malware_file": document.getElementById("malware_file").value,
+        "priority": document.getElementById("priority").value,
+        "force": document.getElementById("force").checked
     }
     var xhttp = new XMLHttpRequest();
     xhttp.onreadystatechange = function() {
         if (this.readyState == 4) {
+            document.getElementById("button_exp").disabled = false;
             if (this.status == 200) {
-                console.log(this.responseText);
+                let job_id = JSON.parse(this.responseText)['job'];
+                show_status('Job ' + job_id + ' queued');
+                refresh_jobs();
+                watch_job(job_id);
             } else {
                 alert(this.responseText);
             }
@@ -24,29 +99,4 @@ function create_exp(form) {
     xhttp.open("POST", "/experiment/create");
     xhttp.setRequestHeader("Content-Type", "application/json");
     xhttp.send(JSON.stringify(args));
-
-    myinterval = setInterval(() => {
-        let xhttp = new XMLHttpRequest();
-        xhttp.onreadystatechange = function() {
-            if (this.readyState == 4) {
-                if (this.status == 200) {
-                    if (JSON.parse(this.responseText)['status'] != 'in progress') {
-                        clearInterval(myinterval);
-                        document.getElementById("button_exp").disabled = false;
-                        document.getElementById("status_exp").style.display = 'none';
-
-                        document.getElementById('exp_status_text').style.display = 'block';
-                        document.getElementById('exp_status_text').innerText = JSON.parse(this.responseText)['status'];
-                        setTimeout(() => {
-                            document.getElementById('exp_status_text').style.display = 'none';
-                        }, 5000);
-                    }
-                } else {
-                    alert(this.responseText);
-                }
-            }
-        };
-        xhttp.open("GET", "/experiment/lastest");
-        xhttp.send();
-    }, 2000);
-}
\ No newline at end of file
+}
@@ -14,7 +14,8 @@ PROJECT_DIR = os.path.dirname(os.path.realpath(__file__))
 
 @bottle.route('/', method='GET')
 def main():
-    return bottle.template('index.html', reports=libweb.available_reports())
+    return bottle.template('index.html', reports=libweb.available_reports(), jobs=libweb.list_jobs(),
+            timings=libweb.timing_percentiles())
 
 
 @bottle.route('/static/<filepath:path>', method='GET')
@@ -35,11 +36,27 @@ def create_experiment():
     if json_args:
         status, resp = libweb.run_experiment(json_args)
 
+        if status == 200:
+            return bottle.HTTPResponse(status=status, body=json.dumps({'status': 'ok', 'job': resp}))
         return bottle.HTTPResponse(status=status, body=json.dumps({'status': resp}))
 
     return bottle.HTTPResponse(status=status, body=json.dumps({'status': body}) if body else '')
 
 
+@bottle.route('/experiment/jobs', method='GET')
+def list_jobs():
+    bottle.response.content_type = 'application/json'
+    return json.dumps({'jobs': libweb.list_jobs()})
+
+
+@bottle.route('/experiment/job/<job_id:int>', method='GET')
+def status_job(job_id):
+    status, response = libweb.get_status_experiment(job_id)
+
+    bottle.response.content_type = 'application/json'
+    return bottle.HTTPResponse(status=status, body=json.dumps(response))
+
+
 @bottle.route('/experiment/<date>', method='GET')
 def get_experiment(date):
     if os.path.isdir(os.path.join(PROJECT_DIR, '..', 'results', date)):
@@ -53,7 +70,7 @@ def status_experiment():
     status, response = libweb.get_status_experiment()
 
     bottle.response.content_type = 'application/json'
-    return bottle.HTTPResponse(status=status, body=json.dumps({'status': response}))
+    return bottle.HTTPResponse(status=status, body=json.dumps(response))
 
 
 if __name__ == '__main__':
@@ -61,7 +78,13 @@ if __name__ == '__main__':
     args.add_argument('-i', '--interface', default='0.0.0.0')
     args.add_argument('-p', '--port', type=int, default=8080)
     args.add_argument('-lf', '--log_file', default='webapp.log')
+    args.add_argument('-c', '--config', help='configuration file with the VMs used to run the jobs ("farm": N '
+            'in a VM entry registers N linked clones of it instead)')
 
     argp = args.parse_args()
 
-    libweb.start_webapp(argp.interface, argp.port, argp.log_file)
+    vms = []
+    if argp.config:
+        vms = [e for e in json.loads(open(argp.config).read()) if 'name' in e]
+
+    libweb.start_webapp(argp.interface, argp.port, argp.log_file, vms)